@@ -4,28 +4,62 @@ RAG Service for Uplifted Mascot.
 Provides API endpoint for querying the knowledge base.
 """
 
+import abc
+import asyncio
+import atexit
+import hashlib
+import hmac
+import inspect
+import json
 import logging
 import os
+import queue
+import re
+import shutil
+import tempfile
+import threading
 import time
-from typing import Optional, List, Dict
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from contextlib import asynccontextmanager
+from functools import cached_property, lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from typing import AsyncIterator, Literal, Optional, List, Dict, Tuple
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel, Field, field_validator
 from google.cloud import aiplatform
-from vertexai.language_models import TextEmbeddingModel
+from vertexai.language_models import TextEmbeddingModel, TextEmbeddingInput
 from vertexai.generative_models import GenerativeModel, GenerationConfig
+from vertexai.preview.tokenization import get_tokenizer_for_model
 from dotenv import load_dotenv
+from cachetools import LRUCache, TTLCache
 import chromadb
+import numpy as np
 from pathlib import Path
 from chromadb.config import Settings
 from slowapi import Limiter, _rate_limit_exceeded_handler
 from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 
+try:
+    from numba import njit, prange, get_num_threads
+except ImportError:  # Optional: only needed for USE_NUMBA_TOPK=1
+    njit = None
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Optional: only needed when REDIS_URL is set
+    aioredis = None
+
 # Load environment variables
 load_dotenv()
 
 # Initialize FastAPI
+# No default_response_class: endpoints with a response_model are serialized straight to JSON
+# bytes by pydantic-core, and a custom class (e.g. ORJSONResponse) would opt out of that path
 app = FastAPI(title="Uplifted Mascot RAG Service")
 
 # Logging configuration
@@ -34,17 +68,49 @@ logging.basicConfig(
     level=getattr(logging, LOG_LEVEL, logging.INFO),
     format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
 )
+# Handlers write to stdout on a background thread; request code only enqueues records, so a
+# slow or blocked container log pipe never stalls the event loop
+_log_queue = queue.SimpleQueue()
+_log_listener = QueueListener(_log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+logging.getLogger().handlers = [QueueHandler(_log_queue)]
+_log_listener.start()
+atexit.register(_log_listener.stop)  # flush what's queued on exit
 logger = logging.getLogger("rag_service")
 
+# Threads for blocking work (ChromaDB queries, local index scans) run via asyncio.to_thread.
+# numpy and the Chroma HTTP client release the GIL, so these overlap across cores within one worker.
+RETRIEVAL_THREADS = int(os.getenv("RETRIEVAL_THREADS", str(min(32, (os.cpu_count() or 1) + 4))))
+
 # Rate limiting configuration (requests per minute per IP)
 RATE_LIMIT_PER_MINUTE = int(os.getenv("RATE_LIMIT_PER_MINUTE", "10"))
+# Where the limiter keeps its counters; in memory they're per worker process (and per pod),
+# e.g. redis://redis:6379/1 shares them (requires the redis package, not in requirements.txt)
+RATE_LIMIT_STORAGE_URI = os.getenv("RATE_LIMIT_STORAGE_URI", "memory://")
 
 # Token limits for Vertex AI (cost control)
 MAX_OUTPUT_TOKENS = int(os.getenv("MAX_OUTPUT_TOKENS", "1024"))  # Max tokens in response
 MAX_INPUT_TOKENS = int(os.getenv("MAX_INPUT_TOKENS", "4096"))    # Max tokens in prompt (Gemini default is higher, but we cap it for cost control)
+# A chunk that overflows the budget is cut at a sentence boundary if at least this many tokens still fit
+MIN_PARTIAL_CHUNK_TOKENS = int(os.getenv("MIN_PARTIAL_CHUNK_TOKENS", "64"))
+# Local tokenizer used to budget prompts; the SDK only ships 1.x names, and 2.x models share the same vocabulary
+TOKENIZER_MODEL = os.getenv("TOKENIZER_MODEL", "gemini-1.5-flash-002")
+# Gemini model: GEMINI_MODEL, else the name saved by `scripts/check_gemini_models.py --write-cache`,
+# else the first entry of get_chat_model's fallback list
+GEMINI_MODEL = os.getenv("GEMINI_MODEL")
+GEMINI_MODEL_CACHE = os.getenv("GEMINI_MODEL_CACHE", str(Path(__file__).parent.parent / ".model_cache"))
+# Cap on concurrent Gemini calls per worker; extra requests wait instead of piling onto Vertex AI quota
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "32"))
+# Waits for a Gemini or embedding slot longer than this are logged, as a sign the caps (or quota) are too low
+SLOT_WAIT_LOG_MS = int(os.getenv("SLOT_WAIT_LOG_MS", "250"))
+# Retrieval confidence (1 - mean distance) below which Gemini is skipped and the no-context reply
+# is returned; 0 disables. Distances depend on the collection's space, so tune per deployment.
+CONFIDENCE_FLOOR = float(os.getenv("CONFIDENCE_FLOOR", "0"))
+# Drop retrieved chunks more than this much farther than the best one (same units as the
+# distances); 0 disables, so top_k chunks are always used
+RETRIEVAL_DISTANCE_MARGIN = float(os.getenv("RETRIEVAL_DISTANCE_MARGIN", "0"))
 
-# Initialize rate limiter (in-memory, per IP)
-limiter = Limiter(key_func=get_remote_address)
+# Initialize rate limiter (per IP; in-memory unless RATE_LIMIT_STORAGE_URI is set)
+limiter = Limiter(key_func=get_remote_address, storage_uri=RATE_LIMIT_STORAGE_URI)
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
@@ -66,39 +132,262 @@ CHROMA_COLLECTION_NAME = os.getenv("CHROMA_COLLECTION_NAME", "uplifted_mascot")
 CHROMA_PERSIST_DIR = os.getenv("CHROMA_PERSIST_DIR", "./chroma_db")
 CHROMA_HOST = os.getenv("CHROMA_HOST")  # If set, use HTTP client to connect to ChromaDB service
 CHROMA_PORT = os.getenv("CHROMA_PORT", "8000")
+# Connection pool for the HTTP client, so queries reuse warm keep-alive connections
+CHROMA_HTTP_MAX_CONNECTIONS = int(os.getenv("CHROMA_HTTP_MAX_CONNECTIONS", "200"))
+CHROMA_HTTP_MAX_KEEPALIVE = int(os.getenv("CHROMA_HTTP_MAX_KEEPALIVE", "50"))
+CHROMA_HTTP_KEEPALIVE_SECONDS = float(os.getenv("CHROMA_HTTP_KEEPALIVE_SECONDS", "60"))
 
 # Legacy Vertex AI Vector Search (optional, for scaling)
 INDEX_ID = os.getenv("VECTOR_INDEX_ID")  # Optional - only if using Vertex AI Vector Search
 ENDPOINT_ID = os.getenv("VECTOR_ENDPOINT_ID")  # Optional
 DEPLOYED_INDEX_ID = os.getenv("DEPLOYED_INDEX_ID", "um_deployed_index")  # Optional
 
-# Initialize Vertex AI
+# Query embedding shape: must match what the ingestion pipeline used (scripts/create_embeddings.py).
+# EMBED_DIM unset keeps the model's native size (768); reduced sizes need text-embedding-004 or newer.
+EMBED_DIM = int(os.getenv("EMBED_DIM")) if os.getenv("EMBED_DIM") else None
+# Questions are embedded as RETRIEVAL_QUERY to pair with the RETRIEVAL_DOCUMENT vectors create_embeddings.py
+# writes; collections ingested before it set a task type need re-ingesting, or EMBED_QUERY_TASK_TYPE=""
+# to embed questions without one as before. textembedding-gecko@001 rejects task types and never gets one.
+EMBED_QUERY_TASK_TYPE = os.getenv("EMBED_QUERY_TASK_TYPE", "RETRIEVAL_QUERY") or None
+
+# Embedding micro-batching: questions arriving within the window share one Vertex AI call
+EMBED_BATCH_WINDOW_MS = int(os.getenv("EMBED_BATCH_WINDOW_MS", "15"))
+EMBED_BATCH_MAX = int(os.getenv("EMBED_BATCH_MAX", "50"))
+EMBED_MAX_CONCURRENCY = int(os.getenv("EMBED_MAX_CONCURRENCY", "8"))  # Batched embedding calls in flight per worker
+# ChromaDB micro-batching (used when the local index is off): lookups within the window share one query
+CHROMA_BATCH_WINDOW_MS = int(os.getenv("CHROMA_BATCH_WINDOW_MS", "5"))
+CHROMA_BATCH_MAX = int(os.getenv("CHROMA_BATCH_MAX", "32"))
+
+# Query caches: repeat questions skip the Vertex AI embedding call and the ChromaDB query
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "2048"))
+EMBED_CACHE_TTL = int(os.getenv("EMBED_CACHE_TTL", "3600"))  # seconds
+
+# Semantic answer cache: near-duplicate questions (cosine similarity >= threshold) reuse a recent answer
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "512"))  # 0 disables
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.97"))
+# Answers (exact-match and semantic) expire so re-ingested documentation shows up in responses
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", "900"))  # seconds
+CACHE_ADMIN_TOKEN = os.getenv("CACHE_ADMIN_TOKEN")  # Enables POST /cache/clear (send as X-Admin-Token)
+
+# Optional Redis cache shared by all workers/pods; in-process caches are still used in front of it
+REDIS_URL = os.getenv("REDIS_URL")  # e.g. redis://redis:6379/0; requires the redis package (not in requirements.txt)
+REDIS_KEY_PREFIX = os.getenv("REDIS_KEY_PREFIX", "um:")
+REDIS_EMBED_TTL = int(os.getenv("REDIS_EMBED_TTL", "86400"))  # Seconds; embeddings only change with the model
+REDIS_ANSWER_TTL = int(os.getenv("REDIS_ANSWER_TTL", "900"))  # Seconds; knowledge base can be re-ingested
+REDIS_TIMEOUT = float(os.getenv("REDIS_TIMEOUT", "0.25"))  # Seconds; a slow Redis must not slow requests down
+
+HEALTH_CACHE_TTL = float(os.getenv("HEALTH_CACHE_TTL", "10"))  # Seconds /health reuses the ChromaDB document count
+
+# In-process exact search over a snapshot of the ChromaDB collection (small corpora only)
+LOCAL_INDEX_MAX_VECTORS = int(os.getenv("LOCAL_INDEX_MAX_VECTORS", "50000"))  # Larger collections query Chroma; 0 disables
+LOCAL_INDEX_REFRESH_SECONDS = int(os.getenv("LOCAL_INDEX_REFRESH_SECONDS", "300"))  # How often to check for re-ingestion
+LOCAL_INDEX_PAGE_SIZE = int(os.getenv("LOCAL_INDEX_PAGE_SIZE", "5000"))  # Entries per collection.get while fingerprinting
+USE_NUMBA_TOPK = os.getenv("USE_NUMBA_TOPK", "0") == "1"  # Requires numba (not in requirements.txt)
+LOCAL_INDEX_DTYPE = os.getenv("LOCAL_INDEX_DTYPE", "float32").lower()  # "int8" quantizes rows (4x less memory)
+# Snapshots are saved here and memory-mapped by later startups / other workers; empty disables
+LOCAL_INDEX_CACHE_DIR = os.getenv(
+    "LOCAL_INDEX_CACHE_DIR", os.path.join(tempfile.gettempdir(), "uplifted_mascot_index")
+)
+
+# Vertex AI transport: gRPC keeps one long-lived channel per client instead of per-call REST requests
+VERTEX_API_TRANSPORT = os.getenv("VERTEX_API_TRANSPORT", "grpc")
+# Idle seconds after which a 1-text embedding is sent so the gRPC channel stays connected between
+# bursts (no reconnect/TLS handshake on the next question); 0 disables
+VERTEX_KEEPALIVE_SECONDS = float(os.getenv("VERTEX_KEEPALIVE_SECONDS", "0"))
+
+# Initialize Vertex AI (once per process; all models share the SDK's client channels)
 if PROJECT_ID:
-    aiplatform.init(project=PROJECT_ID, location=REGION)
+    aiplatform.init(project=PROJECT_ID, location=REGION, api_transport=VERTEX_API_TRANSPORT)
 
 # Initialize models (lazy loading)
 _embedding_model = None
+_embedding_model_name = None  # Which fallback loaded; vectors from different models aren't interchangeable
 _chat_model = None
+_chat_model_name = None  # Resolved Gemini model name, shared by the per-mascot models
+_mascot_models: Dict[str, GenerativeModel] = {}
 _chroma_collection = None  # ChromaDB collection
 _vector_index = None  # Legacy Vertex AI Vector Search (optional)
+_local_index = None  # In-process snapshot of the ChromaDB collection
+_local_index_checked_at = None  # time.monotonic() of the last check (successful or not)
+_local_index_lock = threading.Lock()  # Held by the one thread refreshing the index
+_tokenizer = None
+_tokenizer_unavailable = False  # Set once loading fails so we don't retry the download per request
+
+# Token counts per chunk id, so chunks that keep coming back aren't re-tokenized
+_chunk_token_counts = LRUCache(maxsize=4096)
 
 def get_embedding_model():
     """Get or create embedding model."""
-    global _embedding_model
+    global _embedding_model, _embedding_model_name
     if _embedding_model is None:
         # Try text-embedding-004 first (available in us-east1), fall back to gecko models
         try:
-            _embedding_model = TextEmbeddingModel.from_pretrained("text-embedding-004")
+            _embedding_model_name = "text-embedding-004"
+            _embedding_model = TextEmbeddingModel.from_pretrained(_embedding_model_name)
         except Exception:
             try:
-                _embedding_model = TextEmbeddingModel.from_pretrained("textembedding-gecko@003")
+                _embedding_model_name = "textembedding-gecko@003"
+                _embedding_model = TextEmbeddingModel.from_pretrained(_embedding_model_name)
             except Exception:
-                _embedding_model = TextEmbeddingModel.from_pretrained("textembedding-gecko@001")
+                _embedding_model_name = "textembedding-gecko@001"
+                _embedding_model = TextEmbeddingModel.from_pretrained(_embedding_model_name)
     return _embedding_model
 
+@asynccontextmanager
+async def _acquire_slot(slots: asyncio.Semaphore, label: str):
+    """Hold one of `slots` for the body, logging waits longer than SLOT_WAIT_LOG_MS."""
+    started = time.perf_counter()
+    async with slots:
+        waited_ms = (time.perf_counter() - started) * 1000
+        if waited_ms > SLOT_WAIT_LOG_MS:
+            logger.info("waited %.0f ms for a %s slot", waited_ms, label)
+        yield
+
+# Held for the duration of each batched embedding call
+_embedding_slots = asyncio.Semaphore(EMBED_MAX_CONCURRENCY)
+
+class MicroBatcher(abc.ABC):
+    """
+    Coalesces concurrent requests into batched backend calls.
+    
+    Callers await `submit(item)`; a background task waits up to `window_ms` after the
+    first queued item, then hands everything collected (at most `max_batch` items) to
+    `_flush`, which subclasses must implement to return one result per item, in order.
+    """
+    
+    def __init__(self, window_ms: int, max_batch: int):
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flushes: set = set()  # the loop only holds weak refs to tasks, so keep in-flight flushes alive
+    
+    def start(self):
+        """Start the background batching task (idempotent)."""
+        if self._task is None:
+            self._queue = asyncio.Queue()
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Cancel the background batching task, letting in-flight batches finish."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._flushes:
+            await asyncio.gather(*self._flushes, return_exceptions=True)
+    
+    async def submit(self, item):
+        """Queue `item` for the next batch and wait for its result."""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((item, future))
+        return await future
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Flush in its own task so the next window can fill while the backend responds
+            flush = asyncio.create_task(self._flush_batch(batch))
+            self._flushes.add(flush)
+            flush.add_done_callback(self._flushes.discard)
+    
+    async def _flush_batch(self, batch: List[Tuple[object, asyncio.Future]]):
+        try:
+            results = await self._flush([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+    
+    @abc.abstractmethod
+    async def _flush(self, items: list) -> list:
+        """Process one batch, returning a result per item in order."""
+
+class EmbeddingBatcher(MicroBatcher):
+    """Batches query embeddings into single `get_embeddings_async` requests."""
+    
+    def __init__(self, window_ms: int = EMBED_BATCH_WINDOW_MS, max_batch: int = EMBED_BATCH_MAX):
+        super().__init__(window_ms, max_batch)
+        self.last_call = 0.0  # loop time of the most recent Vertex AI call
+    
+    async def embed(self, text: str) -> np.ndarray:
+        """Embed a single text, sharing the Vertex AI call with concurrent callers."""
+        return await self.submit(text)
+    
+    async def _flush(self, texts: List[str]) -> List[np.ndarray]:
+        task_type = None if _embedding_model_name == "textembedding-gecko@001" else EMBED_QUERY_TASK_TYPE
+        inputs = [TextEmbeddingInput(text=text, task_type=task_type) for text in texts]
+        async with _acquire_slot(_embedding_slots, "embedding"):
+            self.last_call = asyncio.get_running_loop().time()
+            embeddings = await get_embedding_model().get_embeddings_async(
+                inputs,
+                output_dimensionality=EMBED_DIM
+            )
+        return [np.asarray(embedding.values, dtype=np.float32) for embedding in embeddings]
+
+class ChromaQueryBatcher(MicroBatcher):
+    """
+    Batches nearest-neighbour lookups into single multi-vector `collection.query` calls.
+    
+    The batch is queried for the largest requested top_k; results come back sorted by
+    distance, so each caller's result is that query's row cut to its own top_k.
+    """
+    
+    def __init__(self, window_ms: int = CHROMA_BATCH_WINDOW_MS, max_batch: int = CHROMA_BATCH_MAX):
+        super().__init__(window_ms, max_batch)
+    
+    async def query(self, query_embedding: np.ndarray, top_k: int) -> Dict:
+        """Look up one embedding, in the single-query shape `collection.query` returns."""
+        return await self.submit((query_embedding, top_k))
+    
+    async def _flush(self, items: List[Tuple[np.ndarray, int]]) -> List[Dict]:
+        results = await asyncio.to_thread(
+            _query_chroma, [embedding for embedding, _ in items], max(top_k for _, top_k in items)
+        )
+        fields = ("ids", "documents", "metadatas", "distances")
+        return [
+            {field: [results[field][row][:top_k]] if results[field] else None for field in fields}
+            for row, (_, top_k) in enumerate(items)
+        ]
+
+_embedding_batcher = EmbeddingBatcher()
+_chroma_batcher = ChromaQueryBatcher()
+
+def _configured_model_name() -> Optional[str]:
+    """GEMINI_MODEL, or the model name saved in GEMINI_MODEL_CACHE by the offline probe."""
+    if GEMINI_MODEL:
+        return GEMINI_MODEL
+    try:
+        return Path(GEMINI_MODEL_CACHE).read_text(encoding="utf-8").strip() or None
+    except OSError:
+        return None
+
 def get_chat_model():
     """Get or create chat model using modern GenerativeModel API."""
-    global _chat_model
+    global _chat_model, _chat_model_name
+    if _chat_model is None and (model_name := _configured_model_name()):
+        # A configured name is used as-is - no fallback, so a bad name fails at startup warmup
+        _chat_model = GenerativeModel(model_name)
+        _chat_model_name = model_name
+        logger.info("loaded chat model %s", model_name)
     if _chat_model is None:
         # Try Model Garden model names (simple names, no "google/" prefix needed)
         # Using the modern GenerativeModel API
@@ -114,17 +403,18 @@ def get_chat_model():
         last_error = None
         for model_name in model_names:
             try:
-                print(f"Trying to load model: {model_name}")
+                logger.debug("trying chat model %s", model_name)
                 _chat_model = GenerativeModel(model_name)
-                print(f"✓ Successfully loaded model: {model_name}")
+                _chat_model_name = model_name
+                logger.info("loaded chat model %s", model_name)
                 break
             except Exception as e:
                 last_error = e
                 error_msg = str(e)
                 if "404" in error_msg or "not found" in error_msg.lower():
-                    print(f"  ✗ Not found")
+                    logger.info("chat model %s not found", model_name)
                 else:
-                    print(f"  ✗ Error: {error_msg[:80]}")
+                    logger.warning("chat model %s failed to load: %s", model_name, error_msg[:80])
                 continue
         
         if _chat_model is None:
@@ -137,6 +427,122 @@ def get_chat_model():
     
     return _chat_model
 
+def get_mascot_model(mascot: str) -> GenerativeModel:
+    """
+    Get the chat model with `mascot`'s personality set as its system instruction.
+    
+    The personality never changes, so it's sent as a system instruction rather than
+    rebuilt into every prompt; that keeps each request's prompt to the dynamic
+    context + question and gives Gemini a stable prefix for implicit prompt caching.
+    """
+    model = _mascot_models.get(mascot)
+    if model is None:
+        get_chat_model()
+        personality = MASCOT_PERSONALITIES[mascot]
+        model = _mascot_models[mascot] = GenerativeModel(_chat_model_name, system_instruction=personality)
+        _share_prediction_client(model)
+    return model
+
+# GenerativeModel's lazily created async client; a Vertex SDK internal, so checked before use
+_PREDICTION_CLIENT_ATTR = "_prediction_async_client"
+
+@lru_cache(maxsize=1)
+def _can_share_prediction_client() -> bool:
+    """Whether the installed SDK still defines the client as a cached property we can pre-fill."""
+    # getattr_static: a plain hasattr on an instance would create the client it's checking for
+    if isinstance(inspect.getattr_static(GenerativeModel, _PREDICTION_CLIENT_ATTR, None), cached_property):
+        return True
+    logger.warning(
+        "cannot share the Vertex AI prediction client: GenerativeModel.%s is not a cached property in "
+        "this google-cloud-aiplatform version; each mascot model opens its own channel",
+        _PREDICTION_CLIENT_ATTR,
+    )
+    return False
+
+def _share_prediction_client(model: GenerativeModel) -> bool:
+    """
+    Point `model` at the base chat model's async prediction client, if that exists yet.
+    
+    Each GenerativeModel lazily opens its own gRPC channel (a cached property), so without
+    this every mascot would pay a fresh TLS handshake on its first request, and warmup and
+    keepalive pings on the base model would warm a channel no request uses. Only an
+    already-created client is shared: it is bound to the event loop that created it.
+    The SDK has no public way to share it, so this relies on its internal attribute and
+    logs (once) and does nothing if an SDK upgrade renamed it. Returns whether it shared.
+    """
+    if model is _chat_model or not _can_share_prediction_client():
+        return False
+    client = getattr(_chat_model, "__dict__", {}).get(_PREDICTION_CLIENT_ATTR)
+    if client is None:
+        return False
+    model.__dict__[_PREDICTION_CLIENT_ATTR] = client
+    return True
+
+@lru_cache(maxsize=1)
+def _resolve_chroma_path() -> Optional[Path]:
+    """
+    Find the local ChromaDB directory that holds CHROMA_COLLECTION_NAME, or None.
+    
+    Only directories holding a ChromaDB database (chroma.sqlite3) are candidates. A lone
+    candidate is returned without opening it; with several, each is opened to find the
+    one with the collection. The answer is memoized and resolved during startup warmup.
+    """
+    # Try multiple paths for the database - prioritize workspace root
+    # Path(__file__) is rag-service/rag_service.py, so parent.parent is workspace root
+    workspace_root = Path(__file__).parent.parent
+    
+    persist_paths = [
+        workspace_root / "chroma_db",  # Workspace root (most likely location)
+        workspace_root / CHROMA_PERSIST_DIR.lstrip("./"),  # If CHROMA_PERSIST_DIR is relative
+        Path(CHROMA_PERSIST_DIR).resolve(),  # Absolute or resolved path from env
+        Path("chroma_db").resolve(),  # Current directory
+        Path("../chroma_db").resolve(),  # Parent directory
+    ]
+    
+    # Candidates often resolve to the same directory; skip ones with no database in them
+    databases = [path for path in dict.fromkeys(persist_paths) if (path / "chroma.sqlite3").is_file()]
+    if len(databases) == 1:
+        # get_chroma_collection opens it and reports a missing collection
+        return databases[0]
+    
+    # Several databases - check which one has the collection
+    for persist_path in databases:
+        try:
+            test_client = chromadb.PersistentClient(
+                path=str(persist_path),
+                settings=Settings(anonymized_telemetry=False)
+            )
+            # Check if collection exists in this database
+            test_client.get_collection(name=CHROMA_COLLECTION_NAME)
+            logger.debug("found ChromaDB collection at %s", persist_path)
+            return persist_path
+        except Exception:
+            # Could not open this path or the collection isn't in it, try next
+            continue
+    return None
+
+def _chroma_http_settings() -> Settings:
+    """
+    Settings for the ChromaDB HTTP client, with the connection-pool tuning where supported.
+    
+    The chroma_http_* pool fields only exist in recent chromadb releases; older ones would
+    ignore or reject them, so missing fields are left out and logged instead.
+    """
+    pool = {
+        "chroma_http_max_connections": CHROMA_HTTP_MAX_CONNECTIONS,
+        "chroma_http_max_keepalive_connections": CHROMA_HTTP_MAX_KEEPALIVE,
+        "chroma_http_keepalive_secs": CHROMA_HTTP_KEEPALIVE_SECONDS,
+    }
+    known = getattr(Settings, "model_fields", None) or getattr(Settings, "__fields__", {})
+    missing = [name for name in pool if name not in known]
+    if missing:
+        logger.warning(
+            "chromadb %s has no %s setting(s); the HTTP connection pool keeps its defaults (upgrade chromadb to tune it)",
+            getattr(chromadb, "__version__", "?"),
+            ", ".join(missing),
+        )
+    return Settings(anonymized_telemetry=False, **{name: value for name, value in pool.items() if name not in missing})
+
 def get_chroma_collection():
     """Get or create ChromaDB collection."""
     global _chroma_collection
@@ -148,9 +554,9 @@ def get_chroma_collection():
                 client = chromadb.HttpClient(
                     host=CHROMA_HOST,
                     port=int(CHROMA_PORT),
-                    settings=Settings(anonymized_telemetry=False)
+                    settings=_chroma_http_settings()
                 )
-                print(f"✓ Connecting to ChromaDB service at {CHROMA_HOST}:{CHROMA_PORT}")
+                logger.info("connecting to ChromaDB service at %s:%s", CHROMA_HOST, CHROMA_PORT)
             except Exception as e:
                 raise Exception(
                     f"Failed to connect to ChromaDB service at {CHROMA_HOST}:{CHROMA_PORT}. "
@@ -159,62 +565,23 @@ def get_chroma_collection():
                 )
         else:
             # Use persistent client for local development
-            # Try multiple paths for the database - prioritize workspace root
-            # Path(__file__) is rag-service/rag_service.py, so parent.parent is workspace root
-            workspace_root = Path(__file__).parent.parent
-            
-            persist_paths = [
-                workspace_root / "chroma_db",  # Workspace root (most likely location)
-                workspace_root / CHROMA_PERSIST_DIR.lstrip("./"),  # If CHROMA_PERSIST_DIR is relative
-                Path(CHROMA_PERSIST_DIR).resolve(),  # Absolute or resolved path from env
-                Path("chroma_db").resolve(),  # Current directory
-                Path("../chroma_db").resolve(),  # Parent directory
-            ]
-            
-            client = None
-            found_path = None
-            
-            # Try each path - check if it exists AND has the collection
-            for persist_path in persist_paths:
-                # Only try paths that actually exist
-                if persist_path.exists() and persist_path.is_dir():
-                    try:
-                        test_client = chromadb.PersistentClient(
-                            path=str(persist_path),
-                            settings=Settings(anonymized_telemetry=False)
-                        )
-                        # Check if collection exists in this database
-                        try:
-                            test_collection = test_client.get_collection(name=CHROMA_COLLECTION_NAME)
-                            # Collection exists! Use this client
-                            client = test_client
-                            found_path = persist_path
-                            print(f"✓ Found ChromaDB at: {persist_path.absolute()}")
-                            break
-                        except Exception:
-                            # Collection doesn't exist in this database, try next path
-                            continue
-                    except Exception as e:
-                        # Could not connect to this path, try next
-                        continue
-            
-            if client is None:
+            found_path = _resolve_chroma_path()
+            if found_path is None:
                 # No existing database found, create in workspace root
-                default_path = workspace_root / "chroma_db"
-                default_path.mkdir(parents=True, exist_ok=True)
-                client = chromadb.PersistentClient(
-                    path=str(default_path),
-                    settings=Settings(anonymized_telemetry=False)
-                )
-                found_path = default_path
-                print(f"Created new ChromaDB at: {default_path.absolute()}")
+                found_path = Path(__file__).parent.parent / "chroma_db"
+                found_path.mkdir(parents=True, exist_ok=True)
+                logger.info("created new ChromaDB at %s", found_path.absolute())
             else:
-                print(f"Using ChromaDB at: {found_path.absolute()}")
+                logger.info("using ChromaDB at %s", found_path.absolute())
+            client = chromadb.PersistentClient(
+                path=str(found_path),
+                settings=Settings(anonymized_telemetry=False)
+            )
         
         # Get collection
         try:
             _chroma_collection = client.get_collection(name=CHROMA_COLLECTION_NAME)
-            print(f"✓ Loaded ChromaDB collection: {CHROMA_COLLECTION_NAME} ({_chroma_collection.count()} documents)")
+            logger.info("loaded ChromaDB collection %s (%d documents)", CHROMA_COLLECTION_NAME, _chroma_collection.count())
         except Exception as e:
             if CHROMA_HOST:
                 raise Exception(
@@ -223,6 +590,7 @@ def get_chroma_collection():
                     f"Error: {e}"
                 )
             else:
+                _resolve_chroma_path.cache_clear()  # re-probe next time, in case it gets loaded
                 raise Exception(
                     f"ChromaDB collection '{CHROMA_COLLECTION_NAME}' not found in {found_path.absolute()}. "
                     f"Please run: python scripts/load_chromadb.py scripts/embeddings-array.json\n"
@@ -231,6 +599,401 @@ def get_chroma_collection():
     
     return _chroma_collection
 
+# Distance modes shared by LocalIndex and the numba kernel
+_SPACE_MODES = {"l2": 0, "ip": 1, "cosine": 1}  # cosine rows/queries are pre-normalized, so it's "1 - dot" like ip
+
+_numba_topk = None
+if USE_NUMBA_TOPK and njit is None:
+    logger.warning("USE_NUMBA_TOPK=1 but numba is not installed; using numpy top-k")
+elif USE_NUMBA_TOPK:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _numba_topk(matrix, row_scales, q, q_scale, sq_norms, q_sq, mode, k, n_blocks, acc):
+        """
+        Fused distance + top-k: each parallel block scans its rows once, keeping its k
+        best (distance, row) pairs in a small sorted buffer. Caller merges the blocks.
+        
+        Works for float32 and int8 matrices; `acc` is a zero of the accumulator type
+        (float32 or int32) and dot products are rescaled by row_scales[i] * q_scale.
+        """
+        n, d = matrix.shape
+        best_d = np.full((n_blocks, k), np.inf, dtype=np.float32)
+        best_i = np.full((n_blocks, k), -1, dtype=np.int64)
+        block = (n + n_blocks - 1) // n_blocks
+        for b in prange(n_blocks):
+            end = min(n, (b + 1) * block)
+            for i in range(b * block, end):
+                s = acc
+                for j in range(d):
+                    s += matrix[i, j] * q[j]
+                dot = s * row_scales[i] * q_scale
+                dist = sq_norms[i] + q_sq - 2.0 * dot if mode == 0 else 1.0 - dot
+                if dist < best_d[b, k - 1]:
+                    pos = k - 1
+                    while pos > 0 and best_d[b, pos - 1] > dist:
+                        best_d[b, pos] = best_d[b, pos - 1]
+                        best_i[b, pos] = best_i[b, pos - 1]
+                        pos -= 1
+                    best_d[b, pos] = dist
+                    best_i[b, pos] = i
+        return best_d, best_i
+
+class MappedTexts:
+    """
+    Read-only list of strings backed by one memory-mapped UTF-8 blob plus offsets.
+    
+    Only the chunks a query actually returns are paged in and decoded, and every
+    worker mapping the same file shares those pages through the OS page cache.
+    """
+    
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self._blob = blob
+        self._offsets = offsets
+    
+    @staticmethod
+    def write(texts: List[str], blob_path: Path, offsets_path: Path):
+        """Write `texts` in the layout read back by `open`."""
+        offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+        with open(blob_path, "wb") as f:
+            for i, text in enumerate(texts):
+                offsets[i + 1] = offsets[i] + f.write((text or "").encode("utf-8"))
+        np.save(offsets_path, offsets)
+    
+    @classmethod
+    def open(cls, blob_path: Path, offsets_path: Path) -> "MappedTexts":
+        offsets = np.load(offsets_path, mmap_mode="r")
+        # np.memmap rejects empty files, which is what a collection of empty documents writes
+        blob = np.memmap(blob_path, dtype=np.uint8, mode="r") if offsets[-1] else np.zeros(0, dtype=np.uint8)
+        return cls(blob, offsets)
+    
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+    
+    def __getitem__(self, i: int) -> str:
+        return self._blob[self._offsets[i]:self._offsets[i + 1]].tobytes().decode("utf-8")
+    
+    def take(self, indices: List[int]) -> List[str]:
+        """Decode several entries, reading their offsets in one vectorized gather."""
+        idx = np.asarray(indices, dtype=np.int64)
+        starts, ends = self._offsets[idx].tolist(), self._offsets[idx + 1].tolist()
+        blob = self._blob
+        return [blob[start:end].tobytes().decode("utf-8") for start, end in zip(starts, ends)]
+
+class LocalIndex:
+    """
+    Exact nearest-neighbour search over an in-memory copy of a ChromaDB collection.
+    
+    For small corpora one matrix-vector product over all embeddings is much cheaper
+    than a round trip through Chroma's HNSW index. Embeddings are kept as a single
+    contiguous matrix with ids/documents/metadata in parallel lists, and distances are
+    computed in the collection's own space ("l2", "ip" or "cosine") so confidence
+    scores match what Chroma would have returned.
+    
+    With dtype="int8" rows are symmetrically quantized with a per-row scale, cutting the
+    bytes scanned per query by 4x at the cost of slightly approximate distances.
+    """
+    
+    def __init__(
+        self,
+        ids: List[str],
+        embeddings,
+        documents: List[str],
+        metadatas: List[Dict],
+        space: str = "l2",
+        dtype: str = LOCAL_INDEX_DTYPE,
+    ):
+        self.ids = list(ids)
+        self.documents = list(documents)
+        self.metadatas = list(metadatas)
+        self.space = space
+        self.size = len(self.ids)
+        self.quantized = dtype == "int8"
+        
+        matrix = np.asarray(embeddings, dtype=np.float32).reshape(self.size, -1)
+        norms = np.linalg.norm(matrix, axis=1)
+        if space == "cosine":
+            matrix = matrix / np.where(norms == 0, 1.0, norms)[:, None]
+        # Squared norms come from the float rows so l2 distances only approximate the dot product
+        self.sq_norms = np.square(norms, dtype=np.float32)
+        
+        if self.quantized:
+            scales = np.abs(matrix).max(axis=1) / 127.0
+            self.row_scales = np.where(scales == 0, 1.0, scales).astype(np.float32)
+            self.matrix = np.ascontiguousarray(np.round(matrix / self.row_scales[:, None]).astype(np.int8))
+        else:
+            self.row_scales = np.ones(self.size, dtype=np.float32)
+            self.matrix = np.ascontiguousarray(matrix)
+        self.version = None
+        self._warm_kernel()
+    
+    def _warm_kernel(self):
+        # Compile the numba kernel now (index build happens during warmup), not on a user request
+        if _numba_topk is not None and self.size:
+            self._numba_nearest(np.asarray(self.matrix[0], dtype=np.float32) * self.row_scales[0], 1)
+    
+    def save(self, directory: Path):
+        """
+        Write the index as .npy arrays, a UTF-8 document blob and a JSON sidecar for ids/metadata.
+        
+        Written to a temporary sibling and renamed into place, so concurrent workers
+        never see a partial snapshot; if another worker got there first, ours is dropped.
+        """
+        directory.parent.mkdir(parents=True, exist_ok=True)
+        tmp = Path(tempfile.mkdtemp(dir=directory.parent, prefix=".tmp-"))
+        np.save(tmp / "matrix.npy", self.matrix)
+        np.save(tmp / "row_scales.npy", self.row_scales)
+        np.save(tmp / "sq_norms.npy", self.sq_norms)
+        MappedTexts.write(self.documents, tmp / "documents.bin", tmp / "doc_offsets.npy")
+        with open(tmp / "meta.json", "w", encoding="utf-8") as f:
+            json.dump({
+                "space": self.space,
+                "ids": self.ids,
+                "metadatas": self.metadatas,
+            }, f)
+        try:
+            os.rename(tmp, directory)
+        except OSError:
+            shutil.rmtree(tmp, ignore_errors=True)
+    
+    @classmethod
+    def load(cls, directory: Path) -> "LocalIndex":
+        """Load a saved index, memory-mapping arrays and documents read-only (pages shared across workers)."""
+        with open(directory / "meta.json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        index = cls.__new__(cls)
+        index.ids = meta["ids"]
+        index.documents = MappedTexts.open(directory / "documents.bin", directory / "doc_offsets.npy")
+        index.metadatas = meta["metadatas"]
+        index.space = meta["space"]
+        index.size = len(index.ids)
+        index.matrix = np.load(directory / "matrix.npy", mmap_mode="r")
+        index.row_scales = np.load(directory / "row_scales.npy", mmap_mode="r")
+        index.sq_norms = np.load(directory / "sq_norms.npy", mmap_mode="r")
+        index.quantized = index.matrix.dtype == np.int8
+        index.version = None
+        index._warm_kernel()
+        return index
+    
+    @classmethod
+    def from_collection(cls, collection, count: int) -> "LocalIndex":
+        """
+        Snapshot every embedding, document and metadata entry of `collection`.
+        
+        Read in pages of LOCAL_INDEX_PAGE_SIZE into one preallocated float32 matrix, so the
+        peak is the matrix plus one page rather than the whole collection as Python lists.
+        """
+        ids, documents, metadatas = [], [], []
+        matrix = None
+        for offset in range(0, count, LOCAL_INDEX_PAGE_SIZE):
+            page = collection.get(
+                limit=LOCAL_INDEX_PAGE_SIZE, offset=offset, include=["embeddings", "documents", "metadatas"]
+            )
+            n = len(page["ids"])
+            if n == 0:
+                break
+            embeddings = np.asarray(page["embeddings"], dtype=np.float32)
+            if matrix is None:
+                matrix = np.empty((count, embeddings.shape[1]), dtype=np.float32)
+            matrix[len(ids):len(ids) + n] = embeddings
+            ids.extend(page["ids"])
+            documents.extend(page["documents"] if page["documents"] is not None else [""] * n)
+            metadatas.extend(page["metadatas"] if page["metadatas"] is not None else [{}] * n)
+        if not ids:
+            raise ValueError("collection is empty")
+        space = (collection.metadata or {}).get("hnsw:space", "l2")  # Chroma's default space is l2
+        return cls(ids, matrix[:len(ids)], documents, metadatas, space)
+    
+    def _encode_query(self, query_embedding: np.ndarray) -> Tuple[np.ndarray, float, float]:
+        """Return the query in the matrix's dtype, its dequantization scale and its squared norm."""
+        q = np.ascontiguousarray(query_embedding, dtype=np.float32)
+        if self.space == "cosine":
+            norm = np.linalg.norm(q)
+            if norm:
+                q = q / norm
+        q_sq = float(q @ q)
+        if not self.quantized:
+            return q, 1.0, q_sq
+        q_scale = float(np.abs(q).max()) / 127.0 or 1.0
+        return np.round(q / q_scale).astype(np.int8), q_scale, q_sq
+    
+    def distances(self, query_embedding: np.ndarray) -> np.ndarray:
+        """Distance from the query to every stored embedding, in the collection's space."""
+        q, q_scale, q_sq = self._encode_query(query_embedding)
+        if self.quantized:
+            # numpy has no BLAS path for integer matmul; einsum accumulates int8 products in int32
+            dots = np.einsum("ij,j->i", self.matrix, q, dtype=np.int32) * self.row_scales * q_scale
+        else:
+            dots = self.matrix @ q
+        if _SPACE_MODES.get(self.space, 0) == 1:
+            return 1.0 - dots
+        # Squared L2 via ||e||^2 + ||q||^2 - 2 e.q; clamp float error below zero
+        return np.maximum(self.sq_norms + q_sq - 2.0 * dots, 0.0)
+    
+    def _numba_nearest(self, query_embedding: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        q, q_scale, q_sq = self._encode_query(query_embedding)
+        mode = _SPACE_MODES.get(self.space, 0)
+        acc = np.int32(0) if self.quantized else np.float32(0.0)
+        n_blocks = max(1, min(get_num_threads(), self.size))
+        best_d, best_i = _numba_topk(
+            self.matrix, self.row_scales, q, q_scale, self.sq_norms, q_sq, mode, k, n_blocks, acc
+        )
+        best_d, best_i = best_d.ravel(), best_i.ravel()
+        order = np.argsort(best_d)[:k]
+        dists = best_d[order].astype(np.float64)
+        return best_i[order], (np.maximum(dists, 0.0) if mode == 0 else dists)
+    
+    def query(self, query_embedding: np.ndarray, top_k: int) -> Dict:
+        """Return the `top_k` nearest entries in the same shape as `collection.query`."""
+        k = min(top_k, self.size)
+        if k == 0:
+            return {"ids": [[]], "documents": [[]], "metadatas": [[]], "distances": [[]]}
+        if _numba_topk is not None:
+            idx, nearest = self._numba_nearest(query_embedding, k)
+        else:
+            dists = self.distances(query_embedding)
+            idx = np.argpartition(dists, k - 1)[:k]
+            idx = idx[np.argsort(dists[idx])]
+            nearest = dists[idx]
+        # One conversion to Python ints; indexing lists with numpy scalars is ~2x slower
+        rows = idx.tolist()
+        documents = self.documents
+        return {
+            "ids": [[self.ids[i] for i in rows]],
+            "documents": [documents.take(rows) if isinstance(documents, MappedTexts) else [documents[i] for i in rows]],
+            "metadatas": [[self.metadatas[i] for i in rows]],
+            "distances": [nearest.tolist()],
+        }
+
+def _local_index_version(collection, count: int) -> str:
+    """
+    Fingerprint of the collection contents (ids, documents, metadata) plus index settings.
+    
+    Hashes every entry, so re-ingesting edited docs under the same ids and chunk count
+    still gets a new version; read in pages of LOCAL_INDEX_PAGE_SIZE to bound memory.
+    Embeddings are left out: they follow from the documents and are the bulk of the data.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(f"{CHROMA_COLLECTION_NAME}:{count}:{LOCAL_INDEX_DTYPE}".encode("utf-8"))
+    for offset in range(0, count, LOCAL_INDEX_PAGE_SIZE):
+        page = collection.get(limit=LOCAL_INDEX_PAGE_SIZE, offset=offset, include=["documents", "metadatas"])
+        documents = page["documents"] or [""] * len(page["ids"])
+        metadatas = page["metadatas"] or [{}] * len(page["ids"])
+        for doc_id, document, metadata in zip(page["ids"], documents, metadatas):
+            digest.update(doc_id.encode("utf-8"))
+            digest.update(b"\0")
+            digest.update((document or "").encode("utf-8"))
+            digest.update(b"\0")
+            digest.update(json.dumps(metadata, sort_keys=True).encode("utf-8"))
+            digest.update(b"\0")
+    return digest.hexdigest()
+
+# Snapshot directories are named <collection>-<version>; other collections may share the cache dir
+_SNAPSHOT_DIR_RE = re.compile(re.escape(CHROMA_COLLECTION_NAME) + r"-[0-9a-f]{16}")
+
+def _load_or_build_local_index(collection, count: int, version: str) -> LocalIndex:
+    """Memory-map a saved snapshot for `version` if one exists, else build (and save) it."""
+    snapshot_dir = Path(LOCAL_INDEX_CACHE_DIR) / f"{CHROMA_COLLECTION_NAME}-{version}" if LOCAL_INDEX_CACHE_DIR else None
+    if snapshot_dir is not None and snapshot_dir.is_dir():
+        try:
+            index = LocalIndex.load(snapshot_dir)
+            index.version = version
+            logger.info("local index loaded from %s", snapshot_dir)
+            return index
+        except Exception as e:
+            logger.warning("local index snapshot %s unreadable, rebuilding: %s", snapshot_dir, e)
+            shutil.rmtree(snapshot_dir, ignore_errors=True)
+    
+    index = LocalIndex.from_collection(collection, count)
+    index.version = version
+    if snapshot_dir is not None:
+        try:
+            index.save(snapshot_dir)
+            # Older snapshots of this collection belong to previous ingestions
+            for stale in snapshot_dir.parent.iterdir():
+                if stale.name != snapshot_dir.name and _SNAPSHOT_DIR_RE.fullmatch(stale.name) and stale.is_dir():
+                    shutil.rmtree(stale, ignore_errors=True)
+            # Swap the freshly built private copy for the mapped one, shared with other workers
+            index = LocalIndex.load(snapshot_dir)
+            index.version = version
+        except OSError as e:
+            logger.warning("could not save local index snapshot to %s: %s", snapshot_dir, e)
+    return index
+
+def refresh_local_index() -> Optional[LocalIndex]:
+    """
+    Check the collection and (re)build the in-process index if its contents changed.
+    
+    Runs during warmup and then in a background thread, never on a request: until a new
+    index is ready, queries keep using the previous one (or ChromaDB). Failures and empty
+    or oversized collections are remembered like successes, so they are re-checked every
+    LOCAL_INDEX_REFRESH_SECONDS rather than on every request. Returns the current index.
+    """
+    global _local_index, _local_index_checked_at
+    if not _local_index_lock.acquire(blocking=False):
+        return _local_index  # Another thread is already refreshing
+    try:
+        collection = get_chroma_collection()
+        count = collection.count()
+        if count == 0 or count > LOCAL_INDEX_MAX_VECTORS:
+            if _local_index is not None or _local_index_checked_at is None:
+                if count:
+                    logger.info("local index disabled: %d documents exceeds LOCAL_INDEX_MAX_VECTORS=%d", count, LOCAL_INDEX_MAX_VECTORS)
+                else:
+                    logger.info("local index disabled: collection is empty")
+            _local_index = None
+        else:
+            version = _local_index_version(collection, count)
+            if _local_index is None or _local_index.version != version:
+                index = _load_or_build_local_index(collection, count, version)
+                _local_index = index
+                logger.info(
+                    "local index ready: %d documents (space=%s, dtype=%s)",
+                    index.size,
+                    index.space,
+                    index.matrix.dtype,
+                )
+    except Exception as e:
+        logger.warning("local index refresh failed (retrying in %ds): %s", LOCAL_INDEX_REFRESH_SECONDS, e)
+    finally:
+        _local_index_checked_at = time.monotonic()
+        _local_index_lock.release()
+    return _local_index
+
+def get_local_index() -> Optional[LocalIndex]:
+    """
+    Get the in-process index without blocking, starting a background refresh when one is due.
+    
+    Returns None when disabled, not built yet, or when the collection is empty or exceeds
+    LOCAL_INDEX_MAX_VECTORS, in which case callers query ChromaDB directly. The collection
+    fingerprint is re-checked every LOCAL_INDEX_REFRESH_SECONDS so a re-ingested
+    collection is picked up (see refresh_local_index).
+    """
+    if LOCAL_INDEX_MAX_VECTORS <= 0:
+        return None
+    checked_at = _local_index_checked_at
+    due = checked_at is None or time.monotonic() - checked_at >= LOCAL_INDEX_REFRESH_SECONDS
+    if due and not _local_index_lock.locked():
+        threading.Thread(target=refresh_local_index, name="local-index-refresh", daemon=True).start()
+    return _local_index
+
+def get_tokenizer():
+    """Get or create the local Gemini tokenizer (None if it can't be loaded)."""
+    global _tokenizer, _tokenizer_unavailable
+    if _tokenizer is None and not _tokenizer_unavailable:
+        try:
+            _tokenizer = get_tokenizer_for_model(TOKENIZER_MODEL)
+        except Exception as e:
+            # Missing sentencepiece or no network to fetch the vocabulary: fall back to estimating
+            logger.warning("could not load tokenizer for %s, estimating tokens from length: %s", TOKENIZER_MODEL, e)
+            _tokenizer_unavailable = True
+    return _tokenizer
+
+def count_tokens(text: str) -> int:
+    """Count prompt tokens, or estimate them (1 token ≈ 4 characters) without a tokenizer."""
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        return len(text) // 4 + 1
+    return tokenizer.count_tokens(text).total_tokens
+
 def get_vector_index():
     """Get or create Vertex AI Vector Search index connection (legacy, optional)."""
     global _vector_index
@@ -256,10 +1019,21 @@ democracy. You speak clearly and helpfully, focusing on practical solutions.
 Keep responses concise and actionable."""
 }
 
+# Static prompt text around the retrieved context; the personality goes in the system instruction
+_PROMPT_PREFIX = """Use the following context from the project documentation to answer the user's question.
+If the context doesn't contain enough information, say so honestly.
+
+Context:
+"""
+_PROMPT_SUFFIX_FMT = "\n\nQuestion: {q}\n\nAnswer:"
+
 # Request/Response models
+# Validated by pydantic, so handlers can index MASCOT_PERSONALITIES directly
+MascotName = Literal[tuple(MASCOT_PERSONALITIES)]
+
 class AskRequest(BaseModel):
     project: str
-    mascot: str
+    mascot: MascotName
     question: str = Field(..., min_length=1, max_length=1000, description="Question to ask (max 1000 characters)")
     top_k: Optional[int] = Field(default=5, ge=1, le=20, description="Number of context chunks to retrieve (1-20)")
     
@@ -279,146 +1053,658 @@ class AskResponse(BaseModel):
     sources: List[str]
     confidence: Optional[float] = None
 
-def retrieve_context(query_text: str, top_k: int = 5) -> List[Dict]:
+# Last path component for either separator -- older collections may hold Windows-style paths
+_BASENAME_RE = re.compile(r"[^/\\]*$")
+
+def _basename(file_path: str) -> str:
+    return _BASENAME_RE.search(file_path).group(0)
+
+def _chunk_position(chunk_index) -> int:
+    # chunk_index is stored as int or str depending on the loader; unknown sorts last and never adjoins
+    try:
+        return int(chunk_index)
+    except (TypeError, ValueError):
+        return 1 << 30
+
+def _join_chunks(text: str, following: str, adjacent: bool) -> str:
+    """Join two chunks of one file, dropping the repeated paragraph when they're neighbours."""
+    if adjacent:
+        overlap = text.rsplit("\n\n", 1)[-1]
+        if overlap and following.startswith(overlap):
+            return text + following[len(overlap):]
+    return text + "\n\n" + following
+
+@dataclass
+class RetrievedContext:
+    """
+    Retrieved chunks as parallel columns, nearest first.
+    
+    Kept column-wise (as ChromaDB returns them) so prompt assembly, sources and
+    confidence each walk one list instead of hashing keys in per-chunk dicts.
+    """
+    ids: List[str]
+    texts: List[str]
+    file_paths: List[str]
+    filenames: List[str]
+    chunk_indexes: List[str]
+    distances: np.ndarray
+    confidence: float = 0.0  # 1 - mean distance, clipped to [0, 1]
+    
+    def __len__(self) -> int:
+        return len(self.ids)
+    
+    def sources(self) -> List[str]:
+        """Distinct source files in retrieval order (several chunks often share a file)."""
+        return list(dict.fromkeys(self.file_paths))
+    
+    def merged_by_file(self) -> "RetrievedContext":
+        """
+        One entry per source file, for the prompt: that file's chunks in document order.
+        
+        Files keep the rank of their best chunk. Consecutive chunks are joined without
+        the paragraph that ingestion repeats at the start of each chunk (see
+        chunk_text's overlap), so the overlap isn't sent to Gemini twice.
+        """
+        groups: Dict[str, List[int]] = {}
+        for row, file_path in enumerate(self.file_paths):
+            groups.setdefault(file_path, []).append(row)
+        if len(groups) == len(self.ids):
+            return self
+        
+        ids, texts, filenames, distances = [], [], [], []
+        for rows in groups.values():
+            first = rows[0]
+            if len(rows) > 1:
+                rows = sorted(rows, key=lambda row: _chunk_position(self.chunk_indexes[row]))
+            positions = [_chunk_position(self.chunk_indexes[row]) for row in rows]
+            text = self.texts[rows[0]]
+            for i in range(1, len(rows)):
+                text = _join_chunks(text, self.texts[rows[i]], adjacent=positions[i] - positions[i - 1] == 1)
+            ids.append("+".join(self.ids[row] for row in rows))
+            texts.append(text)
+            filenames.append(self.filenames[first])
+            distances.append(float(self.distances[first]))
+        return RetrievedContext(
+            ids=ids,
+            texts=texts,
+            file_paths=list(groups),
+            filenames=filenames,
+            chunk_indexes=[""] * len(ids),
+            distances=np.asarray(distances),
+            confidence=self.confidence,
+        )
+    
+    def within_margin(self, margin: float) -> "RetrievedContext":
+        """Keep the chunks whose distance is within `margin` of the best; confidence covers what's kept."""
+        if margin <= 0 or not len(self):
+            return self
+        # Rows are sorted by distance, so the kept chunks are a prefix
+        n = int(np.searchsorted(self.distances, self.distances[0] + margin, side="right"))
+        if n == len(self):
+            return self
+        distances = self.distances[:n]
+        return RetrievedContext(
+            ids=self.ids[:n],
+            texts=self.texts[:n],
+            file_paths=self.file_paths[:n],
+            filenames=self.filenames[:n],
+            chunk_indexes=self.chunk_indexes[:n],
+            distances=distances,
+            confidence=float(np.clip(1.0 - distances.mean(), 0.0, 1.0)),
+        )
+    
+    @classmethod
+    def empty(cls) -> "RetrievedContext":
+        return cls([], [], [], [], [], np.zeros(0))
+    
+    @classmethod
+    def from_results(cls, results: Dict) -> "RetrievedContext":
+        """Build from a single-query `collection.query` (or LocalIndex.query) result."""
+        ids = results["ids"][0] if results["ids"] else []
+        if not ids:
+            return cls.empty()
+        texts = results["documents"][0] if results["documents"] else [""] * len(ids)
+        metadatas = results["metadatas"][0] if results["metadatas"] else [{}] * len(ids)
+        distances = (
+            np.asarray(results["distances"][0], dtype=np.float64)
+            if results["distances"] else np.zeros(len(ids))
+        )
+        file_paths = [metadata.get("file_path", "") for metadata in metadatas]
+        return cls(
+            ids=list(ids),
+            texts=list(texts),
+            file_paths=file_paths,
+            # `filename` is written at ingestion; basename only for collections loaded before that
+            filenames=[
+                metadata.get("filename") or _basename(file_path)
+                for metadata, file_path in zip(metadatas, file_paths)
+            ],
+            chunk_indexes=[metadata.get("chunk_index", "") for metadata in metadatas],
+            distances=distances,
+            confidence=float(np.clip(1.0 - distances.mean(), 0.0, 1.0)),
+        )
+
+# In-flight retrievals keyed by (question, top_k) so concurrent duplicate questions
+# share a single embedding call + ChromaDB query instead of each issuing their own
+_inflight_retrievals: Dict[Tuple[str, int], asyncio.Task] = {}
+
+# Embedding vectors keyed by normalized question, and retrieved chunks keyed by (question, top_k).
+# Only touched from the event loop, so no lock is needed around them.
+_embed_cache = TTLCache(maxsize=EMBED_CACHE_SIZE, ttl=EMBED_CACHE_TTL)
+_retrieval_cache = TTLCache(maxsize=EMBED_CACHE_SIZE, ttl=EMBED_CACHE_TTL)
+
+def normalize_question(text: str) -> str:
+    """Normalize a question for cache lookups (NFKC, lowercase, collapsed whitespace)."""
+    return unicodedata.normalize("NFKC", " ".join(text.lower().split()))
+
+async def embed_question(query_text: str) -> np.ndarray:
+    """Embed a question, reusing cached vectors and batching with concurrent questions."""
+    normalized = normalize_question(query_text)
+    embedding = _embed_cache.get(normalized)
+    if embedding is None:
+        embedding = await _shared_embedding(normalized)
+        if embedding is None:
+            embedding = await _embedding_batcher.embed(query_text)
+            await _share_embedding(normalized, embedding)
+        _embed_cache[normalized] = embedding
+    return embedding
+
+class SemanticCache:
+    """
+    Ring buffer of recent answers looked up by question-embedding similarity.
+    
+    Embeddings are stored L2-normalized in one float32 matrix, so a lookup is a single
+    matrix-vector product. Each entry is tagged with a scope (mascot, top_k) because
+    both change the answer; only entries in the same scope can match. Entries older
+    than `ttl` seconds never match.
+    """
+    
+    def __init__(
+        self,
+        maxsize: int = SEMANTIC_CACHE_SIZE,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        ttl: float = ANSWER_CACHE_TTL,
+    ):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.ttl = ttl
+        self.clear()
+    
+    def clear(self):
+        """Drop every entry."""
+        self._matrix: Optional[np.ndarray] = None  # allocated on first put, once dimension is known
+        self._scope_ids = np.full(self.maxsize, -1, dtype=np.int32)
+        self._stored_at = np.zeros(self.maxsize, dtype=np.float64)
+        self._scopes: Dict[Tuple[str, int], int] = {}
+        self._values: List = [None] * self.maxsize
+        self._count = 0
+        self._next = 0
+    
+    @staticmethod
+    def _unit(embedding: np.ndarray) -> np.ndarray:
+        vec = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vec)
+        return vec / norm if norm else vec
+    
+    def get(self, scope: Tuple[str, int], embedding: np.ndarray):
+        """Return the cached value most similar to `embedding` within `scope`, or None."""
+        scope_id = self._scopes.get(scope)
+        if scope_id is None or self._count == 0:
+            return None
+        sims = self._matrix[:self._count] @ self._unit(embedding)
+        sims[self._scope_ids[:self._count] != scope_id] = -1.0
+        sims[self._stored_at[:self._count] < time.monotonic() - self.ttl] = -1.0
+        best = int(np.argmax(sims))
+        return self._values[best] if sims[best] >= self.threshold else None
+    
+    def put(self, scope: Tuple[str, int], embedding: np.ndarray, value):
+        """Store `value` under `embedding`, evicting the oldest entry when full."""
+        if self.maxsize <= 0:
+            return
+        vec = self._unit(embedding)
+        if self._matrix is None:
+            self._matrix = np.zeros((self.maxsize, vec.shape[0]), dtype=np.float32)
+        slot = self._next
+        self._matrix[slot] = vec
+        self._scope_ids[slot] = self._scopes.setdefault(scope, len(self._scopes))
+        self._values[slot] = value
+        self._stored_at[slot] = time.monotonic()
+        self._next = (slot + 1) % self.maxsize
+        self._count = min(self._count + 1, self.maxsize)
+
+# Recent AskResponses; like the other caches it's only used from the event loop.
+# Exact repeats (same normalized question, mascot and top_k) are found without embedding.
+_answer_cache = SemanticCache()
+_exact_answers = TTLCache(maxsize=EMBED_CACHE_SIZE, ttl=ANSWER_CACHE_TTL)
+
+_redis = None
+
+def get_redis():
+    """Get the shared Redis client, or None when REDIS_URL is unset or redis isn't installed."""
+    global _redis
+    if _redis is None and REDIS_URL:
+        if aioredis is None:
+            logger.warning("REDIS_URL is set but the redis package is not installed; using in-process caches only")
+            return None
+        _redis = aioredis.Redis.from_url(
+            REDIS_URL, socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT
+        )
+    return _redis
+
+def _redis_key(namespace: str, *parts) -> str:
+    digest = hashlib.sha1("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+    return f"{REDIS_KEY_PREFIX}{namespace}:{digest}"
+
+async def _redis_get(key: str) -> Optional[bytes]:
+    """GET from the shared cache; errors count as a miss so Redis outages don't fail requests."""
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        return await client.get(key)
+    except Exception as e:
+        logger.warning("redis get failed key=%s error=%s", key, e)
+        return None
+
+async def _redis_set(key: str, value: bytes, ttl: int):
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        await client.set(key, value, ex=ttl)
+    except Exception as e:
+        logger.warning("redis set failed key=%s error=%s", key, e)
+
+def _embedding_key(normalized: str) -> str:
+    # Keyed by model too: Redis outlives restarts, and a worker may have fallen back to another model
+    get_embedding_model()
+    return _redis_key("emb", _embedding_model_name, EMBED_DIM or "native", normalized)
+
+async def _shared_embedding(normalized: str) -> Optional[np.ndarray]:
+    # Stored as float16 (half the bytes); cosine/L2 ranking is unaffected at that precision
+    if get_redis() is None:
+        return None
+    data = await _redis_get(_embedding_key(normalized))
+    return np.frombuffer(data, dtype=np.float16).astype(np.float32) if data else None
+
+async def _share_embedding(normalized: str, embedding: np.ndarray):
+    if get_redis() is None:
+        return
+    await _redis_set(
+        _embedding_key(normalized),
+        np.asarray(embedding, dtype=np.float16).tobytes(),
+        REDIS_EMBED_TTL,
+    )
+
+def _exact_answer_key(request_body: "AskRequest") -> Tuple[str, str, int]:
+    return (request_body.mascot, normalize_question(request_body.question), request_body.top_k)
+
+def _answer_key(request_body: "AskRequest") -> str:
+    return _redis_key("ans", normalize_question(request_body.question), request_body.mascot, request_body.top_k)
+
+async def store_answer(
+    request_body: "AskRequest", scope: Tuple[str, int], query_embedding: Optional[np.ndarray], answer: "AskResponse"
+):
+    """Cache a generated answer in the exact and semantic caches and, when configured, in Redis."""
+    _exact_answers[_exact_answer_key(request_body)] = answer
+    if query_embedding is not None:
+        _answer_cache.put(scope, query_embedding, answer)
+    await _redis_set(_answer_key(request_body), answer.model_dump_json().encode("utf-8"), REDIS_ANSWER_TTL)
+
+async def clear_caches() -> int:
+    """Empty this worker's caches and the shared Redis answers; returns Redis keys deleted."""
+    global _local_index_checked_at
+    _local_index_checked_at = None  # re-check the collection on the next query
+    for cache in (_embed_cache, _retrieval_cache, _exact_answers, _health_count_cache, _chunk_token_counts):
+        cache.clear()
+    _answer_cache.clear()
+    client = get_redis()
+    if client is None:
+        return 0
+    deleted = 0
+    try:
+        async for key in client.scan_iter(match=f"{REDIS_KEY_PREFIX}ans:*", count=500):
+            deleted += await client.delete(key)
+    except Exception as e:
+        logger.warning("redis cache clear failed after %d keys: %s", deleted, e)
+    return deleted
+
+async def retrieve_context(query_text: str, top_k: int = 5) -> RetrievedContext:
     """
     Retrieve relevant context from ChromaDB (or Vertex AI Vector Search if configured).
     
+    Results are cached per normalized question and top_k, and identical questions
+    that arrive while a lookup is already running await that lookup's result rather
+    than starting a new one.
+    
     Args:
         query_text: User's question
         top_k: Number of results to retrieve
     
     Returns:
-        List of relevant document chunks with metadata
+        RetrievedContext with the relevant chunks and a confidence derived from
+        their average distance
     """
+    key = (normalize_question(query_text), top_k)
+    cached = _retrieval_cache.get(key)
+    if cached is not None:
+        return cached
+    
+    task = _inflight_retrievals.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_context(query_text, key))
+        _inflight_retrievals[key] = task
+        task.add_done_callback(lambda _: _inflight_retrievals.pop(key, None))
+    # Shield so one client disconnecting doesn't cancel the lookup for everyone else
+    return await asyncio.shield(task)
+
+async def _fetch_context(query_text: str, key: Tuple[str, int]) -> RetrievedContext:
+    """Embed the question and query ChromaDB without blocking the event loop."""
+    _, top_k = key
     try:
-        # Create query embedding
-        embedding_model = get_embedding_model()
-        query_embedding = embedding_model.get_embeddings([query_text])[0]
-        
-        # Use ChromaDB (primary approach)
-        collection = get_chroma_collection()
+        # Create query embedding (cached, batched with any concurrent questions)
+        query_embedding = await embed_question(query_text)
         
-        # Query ChromaDB
-        results = collection.query(
-            query_embeddings=[query_embedding.values],
-            n_results=top_k,
-            include=["documents", "metadatas", "distances"]
-        )
+        # The local index scan is synchronous numpy work, so run it in a worker thread; without
+        # one, ChromaDB is queried in batches shared with concurrent lookups
+        results = await asyncio.to_thread(_query_local_index, query_embedding, top_k)
+        if results is None:
+            results = await _chroma_batcher.query(query_embedding, top_k)
         
-        # Format results
-        context_chunks = []
-        if results["ids"] and len(results["ids"]) > 0:
-            for i in range(len(results["ids"][0])):
-                doc_id = results["ids"][0][i]
-                text = results["documents"][0][i] if results["documents"] else ""
-                metadata = results["metadatas"][0][i] if results["metadatas"] else {}
-                distance = results["distances"][0][i] if results["distances"] else 0.0
-                
-                file_path = metadata.get("file_path", "")
-                filename = metadata.get("filename", file_path.replace("\\", "/").split("/")[-1])
-                chunk_index = metadata.get("chunk_index", "")
-                
-                context_chunks.append({
-                    "text": text,
-                    "file_path": file_path,
-                    "filename": filename,
-                    "distance": distance,
-                    "id": doc_id,
-                    "chunk_index": chunk_index
-                })
+        # Keep results column-wise; confidence comes from one numpy pass over the distances.
+        # Chunks far behind the best match cost prefill tokens without helping the answer.
+        context = RetrievedContext.from_results(results).within_margin(RETRIEVAL_DISTANCE_MARGIN)
         
-        return context_chunks
+        # Only cache non-empty results so transient failures aren't remembered
+        if context:
+            _retrieval_cache[key] = context
+        return context
     
     except Exception as e:
-        print(f"Error retrieving context: {e}")
-        import traceback
-        traceback.print_exc()
-        return []
+        logger.error("error retrieving context: %s", e, exc_info=True)
+        return RetrievedContext.empty()
+
+def _query_local_index(query_embedding: np.ndarray, top_k: int) -> Optional[Dict]:
+    """Query the in-process index, or return None when it is disabled or unavailable."""
+    try:
+        local_index = get_local_index()
+    except Exception as e:
+        logger.warning("local index unavailable, querying ChromaDB: %s", e)
+        return None
+    return local_index.query(query_embedding, top_k) if local_index is not None else None
+
+def _query_chroma(query_embeddings: List[np.ndarray], top_k: int) -> Dict:
+    """Query ChromaDB (primary approach) for several embeddings in one call."""
+    collection = get_chroma_collection()
+    return collection.query(
+        query_embeddings=query_embeddings,
+        n_results=top_k,
+        include=["documents", "metadatas", "distances"]
+    )
 
-def generate_response(question: str, context_chunks: List[Dict], mascot: str) -> str:
+def append_context_pieces(pieces: List[str], context: RetrievedContext, token_budget: int) -> int:
     """
-    Generate response using Gemini with retrieved context.
+    Append the prompt's context section to `pieces` without exceeding `token_budget`.
+    
+    Chunks arrive sorted by ascending distance, so they're taken in order and the
+    first one that doesn't fit ends the context. That chunk is cut at the last
+    sentence boundary that fits, leaving it out entirely if fewer than
+    MIN_PARTIAL_CHUNK_TOKENS remain. Each chunk is appended as separate string
+    pieces so the prompt is built by a single join; returns the number of chunks used.
+    """
+    ap = pieces.append
+    remaining = token_budget
+    used = 0
+    truncated = False
+    for doc_id, filename, text in zip(context.ids, context.filenames, context.texts):
+        tokens = _chunk_token_counts.get(doc_id)
+        if tokens is None:
+            tokens = count_tokens(f"From {filename}:\n{text}")
+            _chunk_token_counts[doc_id] = tokens
+        if tokens > remaining:
+            text = _truncate_chunk(filename, text, tokens, remaining)
+            if not text:
+                break
+            truncated = True
+        if used:
+            ap("\n\n")
+        ap("From ")
+        ap(filename)
+        ap(":\n")
+        ap(text)
+        used += 1
+        remaining -= tokens + 1  # +1 for the "\n\n" separator
+        if truncated:
+            break
+    
+    if truncated or used < len(context):
+        logger.warning(
+            "prompt token budget reached: using %d of %d chunks%s (budget=%d tokens)",
+            used,
+            len(context),
+            ", last one truncated" if truncated else "",
+            token_budget,
+        )
+    return used
+
+_SENTENCE_ENDS = (". ", "! ", "? ", ".\n", "\n\n")
+
+def _truncate_chunk(filename: str, text: str, tokens: int, budget: int) -> str:
+    """Longest prefix of `text` ending a sentence whose "From" entry fits in `budget` tokens, or ""."""
+    if budget < MIN_PARTIAL_CHUNK_TOKENS:
+        return ""
+    # Guess the cut from the chunk's own token density, then back off a sentence at a time
+    limit = len(text) * budget // tokens
+    while limit > 0:
+        cut = max(text.rfind(end, 0, limit) for end in _SENTENCE_ENDS)
+        if cut <= 0:
+            return ""
+        partial = text[:cut + 1]
+        if count_tokens(f"From {filename}:\n{partial}") <= budget:
+            return partial
+        limit = cut
+    return ""
+
+def build_prompt(question: str, context: RetrievedContext, mascot: str) -> str:
+    """
+    Assemble the full Gemini prompt for a question and its retrieved context.
     
     Args:
         question: User's question
-        context_chunks: Retrieved context from vector search
+        context: Retrieved context from vector search
         mascot: Mascot personality to use
     
     Returns:
-        Generated response text
+        Prompt text, with context trimmed to fit MAX_INPUT_TOKENS
     """
-    try:
-        # Get personality prompt
-        personality = MASCOT_PERSONALITIES.get(mascot, MASCOT_PERSONALITIES["gooey"])
-        
-        # Build context text
-        context_text = "\n\n".join([
-            f"From {chunk['filename']}:\n{chunk['text']}"
-            for chunk in context_chunks
-        ])
-        
-        # Build full prompt
-        prompt = f"""{personality}
+    question_part = _PROMPT_SUFFIX_FMT.format(q=question)
+    
+    # Fit per-file context into what's left of MAX_INPUT_TOKENS after the fixed parts
+    budget = MAX_INPUT_TOKENS - _prefix_tokens(mascot) - count_tokens(question_part)
+    pieces = [_PROMPT_PREFIX]
+    append_context_pieces(pieces, context.merged_by_file(), budget)
+    pieces.append(question_part)
+    return "".join(pieces)
 
-Use the following context from the project documentation to answer the user's question.
-If the context doesn't contain enough information, say so honestly.
+@lru_cache(maxsize=None)
+def _prefix_tokens(mascot: str) -> int:
+    """Token count of a mascot's system instruction plus the static prompt prefix (counted once)."""
+    personality = MASCOT_PERSONALITIES[mascot]
+    return count_tokens(personality) + count_tokens(_PROMPT_PREFIX)
 
-Context:
-{context_text}
+# Configure generation parameters (token limits, temperature, etc.)
+GENERATION_CONFIG = GenerationConfig(
+    max_output_tokens=MAX_OUTPUT_TOKENS,
+    temperature=0.7,  # Balanced creativity/consistency for Q&A
+    top_p=0.95,       # Nucleus sampling
+    top_k=40          # Top-K sampling
+)
 
-Question: {question}
+# Held for the duration of each Gemini call (including streams)
+_generation_slots = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
 
-Answer:"""
-        
-        # Truncate prompt if it exceeds MAX_INPUT_TOKENS (rough estimate: 1 token ≈ 4 characters)
-        # This is a conservative estimate to stay under token limits
-        max_input_chars = MAX_INPUT_TOKENS * 4
-        if len(prompt) > max_input_chars:
-            print(f"Warning: Prompt length ({len(prompt)} chars) exceeds estimated token limit. Truncating...")
-            # Keep the personality and question, truncate context
-            personality_and_question = f"""{personality}
-
-Use the following context from the project documentation to answer the user's question.
-If the context doesn't contain enough information, say so honestly.
+async def generate_response(question: str, context: RetrievedContext, mascot: str) -> str:
+    """
+    Generate response using Gemini with retrieved context.
+    
+    Args:
+        question: User's question
+        context: Retrieved context from vector search
+        mascot: Mascot personality to use
+    
+    Returns:
+        Generated response text
+    
+    Raises:
+        Exception: If the Gemini call fails (callers decide how to surface it)
+    """
+    prompt = build_prompt(question, context, mascot)
+    
+    # Generate response
+    chat_model = get_mascot_model(mascot)
+    
+    # Single-turn generate_content; every GenerativeModel has it, so there's no chat-API fallback
+    # (an AttributeError raised inside the SDK would otherwise re-send the whole prompt)
+    async with _acquire_slot(_generation_slots, "Gemini"):
+        response = await chat_model.generate_content_async(
+            prompt,
+            generation_config=GENERATION_CONFIG
+        )
+    return response.text
 
-Context:
-"""
-            question_part = f"\n\nQuestion: {question}\n\nAnswer:"
-            available_chars = max_input_chars - len(personality_and_question) - len(question_part)
-            # Truncate context text to fit
-            if len(context_text) > available_chars:
-                context_text = context_text[:available_chars] + "\n\n[Context truncated due to length limits]"
-            prompt = personality_and_question + context_text + question_part
-        
-        # Generate response
-        chat_model = get_chat_model()
-        
-        # Configure generation parameters (token limits, temperature, etc.)
-        generation_config = GenerationConfig(
-            max_output_tokens=MAX_OUTPUT_TOKENS,
-            temperature=0.7,  # Balanced creativity/consistency for Q&A
-            top_p=0.95,       # Nucleus sampling
-            top_k=40          # Top-K sampling
+async def stream_response(question: str, context: RetrievedContext, mascot: str) -> AsyncIterator[str]:
+    """
+    Generate a response like `generate_response`, yielding text as Gemini produces it.
+    
+    Raises:
+        Exception: If the Gemini call fails (possibly after some text was yielded)
+    """
+    prompt = build_prompt(question, context, mascot)
+    chat_model = get_mascot_model(mascot)
+    async with _acquire_slot(_generation_slots, "Gemini"):
+        responses = await chat_model.generate_content_async(
+            prompt,
+            generation_config=GENERATION_CONFIG,
+            stream=True
         )
-        
-        # Use generate_content for single-turn (simpler, may avoid deprecation warnings)
-        # Or start_chat for multi-turn conversations
+        async for chunk in responses:
+            try:
+                text = chunk.text
+            except ValueError:
+                # Chunks carrying only finish/safety metadata have no text part
+                continue
+            if text:
+                yield text
+
+@app.on_event("startup")
+async def configure_thread_pool():
+    """Size the event loop's default executor, which asyncio.to_thread uses."""
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=RETRIEVAL_THREADS, thread_name_prefix="retrieval")
+    )
+
+@app.on_event("startup")
+async def start_batchers():
+    """Start the embedding and ChromaDB micro-batchers on the server's event loop."""
+    _embedding_batcher.start()
+    _chroma_batcher.start()
+
+@app.on_event("startup")
+async def _warmup():
+    """
+    Resolve models and the ChromaDB collection before serving traffic.
+    
+    Model probing and the first Vertex AI calls (channel setup) can take several seconds;
+    doing it here keeps that cost out of the first user's request. Independent loaders
+    run concurrently. Failures are logged rather than raised so the service still starts
+    and /health can report the problem.
+    """
+    async def load(name, loader):
         try:
-            # Try direct generate_content first (simpler API) with generation config
-            response = chat_model.generate_content(
-                prompt,
-                generation_config=generation_config
+            await asyncio.to_thread(loader)
+        except Exception as e:
+            logger.warning("warmup failed to load %s: %s", name, e)
+    
+    await asyncio.gather(
+        load("embedding model", get_embedding_model),
+        load("chat models", lambda: [get_mascot_model(mascot) for mascot in MASCOT_PERSONALITIES]),
+        load("ChromaDB collection", get_chroma_collection),
+        load("Vector Search endpoint", get_vector_index),
+        load("tokenizer", get_tokenizer),
+    )
+    # Built from the collection, so only once that has loaded
+    if LOCAL_INDEX_MAX_VECTORS > 0:
+        await load("local index", refresh_local_index)
+    
+    async def ping_gemini():
+        try:
+            await _chat_model.generate_content_async(
+                "ping",
+                generation_config=GenerationConfig(max_output_tokens=1)
             )
-            return response.text
-        except AttributeError:
-            # Fallback to chat API if generate_content doesn't work
-            chat = chat_model.start_chat()
-            response = chat.send_message(prompt, generation_config=generation_config)
-            return response.text
+        except Exception as e:
+            logger.warning("warmup Gemini ping failed: %s", e)
+        # The ping opened the base model's channel on this loop; mascot models reuse it
+        for model in _mascot_models.values():
+            _share_prediction_client(model)
     
-    except Exception as e:
-        print(f"Error generating response: {e}")
-        return f"I apologize, but I encountered an error: {str(e)}"
+    async def ping_embeddings():
+        try:
+            embedding = await _embedding_batcher.embed("ping")
+        except Exception as e:
+            logger.warning("warmup embedding ping failed: %s", e)
+            return
+        if _local_index is None and _chroma_collection is not None:
+            # Without the local index, ChromaDB loads its HNSW segment on the first query; do that now
+            try:
+                await _chroma_batcher.query(embedding, 1)
+            except Exception as e:
+                logger.warning("warmup ChromaDB query failed: %s", e)
+    
+    pings = [ping_embeddings()] if _embedding_model is not None else []
+    if _chat_model is not None:
+        pings.append(ping_gemini())
+    await asyncio.gather(*pings)
+
+_keepalive_task: Optional[asyncio.Task] = None
+
+async def _keep_vertex_warm():
+    """Embed a tiny text whenever the channel has been idle for VERTEX_KEEPALIVE_SECONDS."""
+    loop = asyncio.get_running_loop()
+    while True:
+        idle = loop.time() - _embedding_batcher.last_call
+        if idle < VERTEX_KEEPALIVE_SECONDS:
+            await asyncio.sleep(VERTEX_KEEPALIVE_SECONDS - idle)
+            continue
+        try:
+            await _embedding_batcher.embed("ping")
+        except Exception as e:
+            logger.debug("vertex keepalive ping failed: %s", e)
+            await asyncio.sleep(VERTEX_KEEPALIVE_SECONDS)
+
+@app.on_event("startup")
+async def start_vertex_keepalive():
+    """Start the Vertex AI channel keepalive, if enabled."""
+    global _keepalive_task
+    if VERTEX_KEEPALIVE_SECONDS > 0:
+        _keepalive_task = asyncio.create_task(_keep_vertex_warm())
+
+@app.on_event("shutdown")
+async def stop_vertex_keepalive():
+    """Stop the Vertex AI channel keepalive."""
+    if _keepalive_task is not None:
+        _keepalive_task.cancel()
+
+@app.on_event("shutdown")
+async def stop_batchers():
+    """Stop the micro-batchers, letting in-flight batches finish."""
+    await asyncio.gather(_embedding_batcher.stop(), _chroma_batcher.stop())
+
+@app.on_event("shutdown")
+async def close_redis():
+    """Close the shared-cache connection pool, if one was opened."""
+    if _redis is not None:
+        await _redis.aclose()
 
 @app.get("/")
 def root():
@@ -429,21 +1715,60 @@ def root():
         "project": PROJECT_ID
     }
 
-@app.get("/health")
-def health():
-    """Detailed health check."""
+# /health is polled by probes and dashboards; a count() is a round-trip on the HTTP client
+_health_count_cache = TTLCache(maxsize=1, ttl=HEALTH_CACHE_TTL)
+
+def _chroma_status(use_cache: bool = True) -> Dict:
+    """ChromaDB status for the health endpoints, reusing a recent document count if allowed."""
     try:
-        collection = get_chroma_collection()
-        chroma_status = {
+        count = _health_count_cache.get(CHROMA_COLLECTION_NAME) if use_cache else None
+        if count is None:
+            count = get_chroma_collection().count()
+            _health_count_cache[CHROMA_COLLECTION_NAME] = count
+        return {
             "configured": True,
             "collection": CHROMA_COLLECTION_NAME,
-            "document_count": collection.count()
+            "document_count": count
         }
     except Exception as e:
-        chroma_status = {
+        return {
             "configured": False,
             "error": str(e)
         }
+
+@app.post("/cache/clear")
+async def cache_clear(request: Request):
+    """
+    Admin: empty the answer/embedding/retrieval caches, e.g. after re-ingesting docs.
+    
+    Only enabled when CACHE_ADMIN_TOKEN is set. In-process caches are per worker, so
+    with several workers only the one serving this request is cleared (Redis is shared).
+    """
+    if not CACHE_ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not hmac.compare_digest(request.headers.get("X-Admin-Token", ""), CACHE_ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+    deleted = await clear_caches()
+    logger.info("caches cleared redis_keys=%d", deleted)
+    return {"status": "cleared", "redis_keys_deleted": deleted}
+
+@app.get("/livez")
+def livez():
+    """Liveness probe: the process is up and serving. Touches no dependencies."""
+    return {"status": "alive"}
+
+@app.get("/readyz")
+def readyz():
+    """Readiness probe: checks ChromaDB for real; 503 until the collection is reachable."""
+    chroma_status = _chroma_status(use_cache=False)
+    if not chroma_status["configured"]:
+        return JSONResponse(status_code=503, content={"status": "not ready", "chromadb": chroma_status})
+    return {"status": "ready", "chromadb": chroma_status}
+
+@app.get("/health")
+def health():
+    """Detailed health check."""
+    chroma_status = _chroma_status()
     
     return {
         "status": "healthy",
@@ -455,9 +1780,92 @@ def health():
         }
     }
 
+NO_CONTEXT_RESPONSE = "I couldn't find relevant information in the knowledge base. Please try rephrasing your question."
+
+def _low_confidence_answer(
+    endpoint: str, client_ip: str, request_body: AskRequest, context: RetrievedContext
+) -> Optional[AskResponse]:
+    """The no-context reply when retrieval is below CONFIDENCE_FLOOR, so Gemini isn't called."""
+    if context and context.confidence >= CONFIDENCE_FLOOR:
+        return None
+    logger.info(
+        "%s no-context ip=%s chunks=%d confidence=%.2f question=\"%s\"",
+        endpoint,
+        client_ip,
+        len(context),
+        context.confidence,
+        request_body.question.strip(),
+    )
+    return AskResponse(
+        response=NO_CONTEXT_RESPONSE,
+        sources=context.sources(),
+        confidence=context.confidence
+    )
+
+def _log_request(endpoint: str, client_ip: str, request_body: AskRequest):
+    """Log an incoming question."""
+    logger.info(
+        "%s request ip=%s mascot=%s top_k=%s question=\"%s\"",
+        endpoint,
+        client_ip,
+        request_body.mascot,
+        request_body.top_k,
+        request_body.question.strip(),
+    )
+
+async def _lookup_cached_answer(
+    endpoint: str, client_ip: str, request_body: AskRequest
+) -> Tuple[Tuple[str, int], Optional[np.ndarray], Optional[AskResponse]]:
+    """
+    Check the caches for this question: an exact match in-process, then in Redis (if
+    configured), then a near-duplicate in the semantic cache.
+    
+    The embedding is cached, so retrieve_context afterwards reuses it rather than re-embedding.
+    
+    Returns:
+        Tuple of (cache scope, query embedding or None if embedding failed, cached answer or None)
+    """
+    answer_scope = (request_body.mascot, request_body.top_k)
+    exact_key = _exact_answer_key(request_body)
+    cached_answer = _exact_answers.get(exact_key)
+    if cached_answer is not None:
+        logger.info("%s cache-hit ip=%s mascot=%s", endpoint, client_ip, request_body.mascot)
+        return answer_scope, None, cached_answer
+    shared = await _redis_get(_answer_key(request_body))
+    if shared is not None:
+        logger.info("%s shared-cache-hit ip=%s mascot=%s", endpoint, client_ip, request_body.mascot)
+        cached_answer = _exact_answers[exact_key] = AskResponse.model_validate_json(shared)
+        return answer_scope, None, cached_answer
+    try:
+        query_embedding = await embed_question(request_body.question)
+    except Exception as e:
+        logger.warning("%s embedding failed ip=%s error=%s", endpoint, client_ip, e)
+        return answer_scope, None, None
+    cached_answer = _answer_cache.get(answer_scope, query_embedding)
+    if cached_answer is not None:
+        logger.info("%s semantic-cache-hit ip=%s mascot=%s", endpoint, client_ip, request_body.mascot)
+    return answer_scope, query_embedding, cached_answer
+
+def _log_response(
+    endpoint: str, client_ip: str, request_body: AskRequest, chunk_count: int, confidence: float, response_text: str
+):
+    preview = response_text.replace("\n", " ")[:500]
+    logger.info(
+        "%s response ip=%s mascot=%s top_k=%s chunks=%d confidence=%.2f question=\"%s\" preview=\"%s%s\"",
+        endpoint,
+        client_ip,
+        request_body.mascot,
+        request_body.top_k,
+        chunk_count,
+        confidence,
+        request_body.question.strip(),
+        preview,
+        "..." if len(response_text) > 500 else "",
+    )
+
 @app.post("/ask-mascot", response_model=AskResponse)
 @limiter.limit(f"{RATE_LIMIT_PER_MINUTE}/minute")  # Rate limit: configurable requests per minute per IP
-def ask_mascot(request: Request, request_body: AskRequest):
+async def ask_mascot(request: Request, request_body: AskRequest):
     """
     Main endpoint for asking the mascot a question.
     
@@ -471,72 +1879,135 @@ def ask_mascot(request: Request, request_body: AskRequest):
         AskResponse with generated answer and sources
     """
     client_ip = request.client.host if request.client else "unknown"
-    logger.info(
-        "ask-mascot request ip=%s mascot=%s top_k=%s question=\"%s\"",
-        client_ip,
-        request_body.mascot,
-        request_body.top_k,
-        request_body.question.strip(),
-    )
+    _log_request("ask-mascot", client_ip, request_body)
     
-    # Validate mascot
-    if request_body.mascot not in MASCOT_PERSONALITIES:
-        logger.warning("ask-mascot invalid mascot ip=%s mascot=%s", client_ip, request_body.mascot)
-        raise HTTPException(
-            status_code=400,
-            detail=f"Unknown mascot: {request_body.mascot}. Available: {list(MASCOT_PERSONALITIES.keys())}"
-        )
+    # Near-duplicate of a recently answered question? Skip retrieval and generation entirely.
+    answer_scope, query_embedding, cached_answer = await _lookup_cached_answer("ask-mascot", client_ip, request_body)
+    if cached_answer is not None:
+        return cached_answer
     
     # Retrieve relevant context
-    context_chunks = retrieve_context(request_body.question, request_body.top_k)
+    context = await retrieve_context(request_body.question, request_body.top_k)
     logger.info(
         "ask-mascot context ip=%s chunks=%d",
         client_ip,
-        len(context_chunks),
+        len(context),
     )
     
-    if not context_chunks:
-        logger.info("ask-mascot no-context ip=%s question=\"%s\"", client_ip, request_body.question.strip())
-        return AskResponse(
-            response="I couldn't find relevant information in the knowledge base. Please try rephrasing your question.",
-            sources=[],
-            confidence=0.0
-        )
+    # Nothing retrieved, or nothing close enough to be worth a Gemini call
+    no_context = _low_confidence_answer("ask-mascot", client_ip, request_body, context)
+    if no_context is not None:
+        return no_context
     
     # Generate response
-    response_text = generate_response(
-        request_body.question,
-        context_chunks,
-        request_body.mascot
-    )
+    generated = True
+    try:
+        response_text = await generate_response(
+            request_body.question,
+            context,
+            request_body.mascot
+        )
+    except Exception as e:
+        logger.error("ask-mascot generation failed ip=%s error=%s", client_ip, e, exc_info=True)
+        response_text = f"I apologize, but I encountered an error: {str(e)}"
+        generated = False
     
     # Extract sources
-    sources = [
-        chunk["file_path"] for chunk in context_chunks
-    ]
+    sources = context.sources()
+    confidence = context.confidence
     
-    # Calculate confidence (simple: based on average distance)
-    avg_distance = sum(chunk["distance"] for chunk in context_chunks) / len(context_chunks)
-    confidence = max(0.0, min(1.0, 1.0 - avg_distance))  # Convert distance to confidence
+    _log_response("ask-mascot", client_ip, request_body, len(context), confidence, response_text)
     
-    preview = response_text.replace("\n", " ")[:500]
-    logger.info(
-        "ask-mascot response ip=%s mascot=%s top_k=%s chunks=%d confidence=%.2f question=\"%s\" preview=\"%s%s\"",
-        client_ip,
-        request_body.mascot,
-        request_body.top_k,
-        len(context_chunks),
-        confidence,
-        request_body.question.strip(),
-        preview,
-        "..." if len(response_text) > 500 else "",
-    )
-    
-    return AskResponse(
+    answer = AskResponse(
         response=response_text,
         sources=sources,
         confidence=confidence
     )
+    # Don't cache error apologies
+    if generated:
+        await store_answer(request_body, answer_scope, query_embedding, answer)
+    return answer
+
+def _sse(payload: Dict) -> str:
+    """Format one Server-Sent Events message."""
+    return f"data: {json.dumps(payload)}\n\n"
+
+async def _replay_answer(answer: AskResponse) -> AsyncIterator[str]:
+    """Send an already-complete answer using the streaming event format."""
+    yield _sse({"sources": answer.sources, "confidence": answer.confidence})
+    yield _sse({"delta": answer.response})
+    yield _sse({"done": True})
+
+@app.post("/ask-mascot/stream")
+@limiter.limit(f"{RATE_LIMIT_PER_MINUTE}/minute")  # Shares the per-IP limit setting with /ask-mascot
+async def ask_mascot_stream(request: Request, request_body: AskRequest):
+    """
+    Streaming variant of /ask-mascot using Server-Sent Events.
+    
+    Emits a `data: {"sources": [...], "confidence": ...}` event first, then
+    `data: {"delta": "..."}` events as Gemini produces text, then `data: {"done": true}`.
+    
+    Args:
+        request: FastAPI Request object (for rate limiting)
+        request_body: AskRequest with project, mascot, and question
+    
+    Returns:
+        StreamingResponse with media type text/event-stream
+    """
+    client_ip = request.client.host if request.client else "unknown"
+    _log_request("ask-mascot-stream", client_ip, request_body)
+    # X-Accel-Buffering stops nginx (the frontend proxy) from holding events until the stream ends
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    
+    answer_scope, query_embedding, cached_answer = await _lookup_cached_answer(
+        "ask-mascot-stream", client_ip, request_body
+    )
+    if cached_answer is not None:
+        return StreamingResponse(_replay_answer(cached_answer), media_type="text/event-stream", headers=headers)
+    
+    context = await retrieve_context(request_body.question, request_body.top_k)
+    logger.info(
+        "ask-mascot-stream context ip=%s chunks=%d",
+        client_ip,
+        len(context),
+    )
+    
+    no_context = _low_confidence_answer("ask-mascot-stream", client_ip, request_body, context)
+    if no_context is not None:
+        return StreamingResponse(_replay_answer(no_context), media_type="text/event-stream", headers=headers)
+    
+    sources = context.sources()
+    confidence = context.confidence
+    
+    async def events() -> AsyncIterator[str]:
+        # Sources are known before Gemini starts, so the UI can show citations right away
+        yield _sse({"sources": sources, "confidence": confidence})
+        parts = []
+        generated = True
+        try:
+            async for delta in stream_response(request_body.question, context, request_body.mascot):
+                parts.append(delta)
+                yield _sse({"delta": delta})
+        except Exception as e:
+            logger.error("ask-mascot-stream generation failed ip=%s error=%s", client_ip, e, exc_info=True)
+            apology = f"I apologize, but I encountered an error: {str(e)}"
+            parts.append(apology)
+            generated = False
+            yield _sse({"delta": apology})
+        yield _sse({"done": True})
+        
+        response_text = "".join(parts)
+        _log_response("ask-mascot-stream", client_ip, request_body, len(context), confidence, response_text)
+        # Completed streams feed the same semantic cache as /ask-mascot
+        if generated:
+            await store_answer(
+                request_body,
+                answer_scope,
+                query_embedding,
+                AskResponse(response=response_text, sources=sources, confidence=confidence)
+            )
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
 
 if __name__ == "__main__":
     import uvicorn
@@ -556,6 +2027,23 @@ if __name__ == "__main__":
         print("\nOr set up Vertex AI Vector Search (see 03-vector-storage.md for scaling)")
         raise
     
-    # Run server
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Run server. One worker by default: each extra worker (WEB_CONCURRENCY, opt-in) is a separate
+    # process with its own warmup, caches and local index, and - unless RATE_LIMIT_STORAGE_URI
+    # is set - its own rate-limit counters, multiplying the effective per-IP limit.
+    # "auto" picks uvloop/httptools (uvicorn[standard]) where available.
+    # log_config=None keeps uvicorn on the logging setup above instead of installing its own.
+    # Keep-alive outlasts uvicorn's 5 s default so clients and proxies reuse connections between
+    # questions; LIMIT_CONCURRENCY (unset = no limit) makes an overloaded worker answer 503 early.
+    workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    uvicorn.run(
+        "rag_service:app" if workers > 1 else app,
+        host="0.0.0.0",
+        port=8000,
+        loop="auto",
+        http="auto",
+        workers=workers,
+        timeout_keep_alive=int(os.getenv("KEEPALIVE_TIMEOUT", "30")),
+        limit_concurrency=int(os.getenv("LIMIT_CONCURRENCY")) if os.getenv("LIMIT_CONCURRENCY") else None,
+        log_config=None,
+    )
 
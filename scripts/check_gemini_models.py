@@ -1,12 +1,25 @@
 #!/usr/bin/env python3
 """
 Check which Gemini models are available in your GCP project/region.
+
+With --write-cache [path], the recommended model name is saved (default: .model_cache
+in the repository root) and used by the RAG service unless GEMINI_MODEL is set.
+
+Results are cached in ~/.cache/uplifted-mascot for 24 hours; pass --refresh to probe
+again. With --fast, models are probed one at a time, Flash first, stopping at the
+first that works (the one that would be recommended anyway).
 """
 
+import asyncio
+import fnmatch
 import os
+import re
 import sys
+from pathlib import Path
+from google.api_core import exceptions as api_exceptions
 from google.cloud import aiplatform
 from vertexai.generative_models import GenerativeModel
+from probe_cache import cache_path, read_cache, write_cache
 
 # Load environment variables
 from dotenv import load_dotenv
@@ -15,6 +28,18 @@ load_dotenv()
 PROJECT_ID = os.getenv("GCP_PROJECT_ID")
 REGION = os.getenv("GCP_REGION", "us-east1")
 
+CACHE_KEY = "gemini"
+FAST = "--fast" in sys.argv
+
+# Models are probed concurrently; transient errors get a few tries with exponential backoff
+PROBE_CONCURRENCY = 8
+PROBE_ATTEMPTS = 3
+RETRYABLE_ERRORS = (
+    api_exceptions.ResourceExhausted,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.InternalServerError,
+)
+
 if not PROJECT_ID:
     print("Error: GCP_PROJECT_ID not set in environment")
     sys.exit(1)
@@ -22,9 +47,6 @@ if not PROJECT_ID:
 print(f"Checking Gemini models for project: {PROJECT_ID}, region: {REGION}")
 print("=" * 60)
 
-# Initialize Vertex AI
-aiplatform.init(project=PROJECT_ID, location=REGION)
-
 # List of model names to try - from Model Garden shortnames
 # Using modern GenerativeModel API (simple names, no "google/" prefix)
 model_names = [
@@ -39,48 +61,101 @@ model_names = [
     "gemini-pro",
 ]
 
-print("\nTrying GenerativeModel() with various names (modern API):\n")
+# Which call to test each model family with, so probing doesn't discover the API by trial
+# and error. Patterns are fnmatch globs, tried in order; unlisted names use generate_content.
+MODEL_CAPS = {
+    "gemini-2.5-*": {"api": "generate_content"},
+    "gemini-2.0-*": {"api": "generate_content"},
+    "gemini-1.5-*": {"api": "generate_content"},
+    "gemini-pro": {"api": "start_chat"},
+}
+DEFAULT_CAPS = {"api": "generate_content"}
+_CAPS_PATTERNS = [(re.compile(fnmatch.translate(pattern)), caps) for pattern, caps in MODEL_CAPS.items()]
 
-available_models = []
-working_models = []  # Models that actually work (not just load)
-for model_name in model_names:
-    try:
-        print(f"  Trying: {model_name}...", end=" ")
+def model_caps(model_name: str) -> dict:
+    for pattern, caps in _CAPS_PATTERNS:
+        if pattern.match(model_name):
+            return caps
+    return DEFAULT_CAPS
+
+async def test_model(model: GenerativeModel, api: str):
+    if api == "start_chat":
+        await model.start_chat().send_message_async("test")
+    else:
+        await model.generate_content_async("test")
+
+async def probe(model_name: str, slots: asyncio.Semaphore):
+    """
+    Test one model name; return (found, works, status line).
+    
+    Only API errors are reported as a failed probe; anything else is a bug and propagates.
+    """
+    api = model_caps(model_name)["api"]
+    async with slots:
         model = GenerativeModel(model_name)
-        print("✓ Loaded", end="")
-        available_models.append(model_name)
-        # Try to test it works - use generate_content (simpler, may avoid deprecation)
-        try:
-            # Try generate_content first (simpler, single-turn)
-            response = model.generate_content("test")
-            print(" ✓ Works (generate_content)")
-            working_models.append(model_name)
-        except AttributeError:
-            # Fallback to chat API if generate_content doesn't exist
+        for attempt in range(PROBE_ATTEMPTS):
             try:
-                chat = model.start_chat()
-                response = chat.send_message("test")
-                print(" ✓ Works (start_chat)")
-                working_models.append(model_name)
-            except Exception as e2:
-                error_msg = str(e2)
-                if "404" in error_msg or "not found" in error_msg.lower():
-                    print(" ✗ Chat test failed (404)")
-                else:
-                    print(f" ✗ Chat test failed: {error_msg[:50]}")
-        except Exception as e:
-            # Other errors from generate_content
-            error_msg = str(e)
-            if "404" in error_msg or "not found" in error_msg.lower():
-                print(" ✗ Test failed (404)")
-            else:
-                print(f" ✗ Test failed: {error_msg[:50]}")
-    except Exception as e:
-        error_msg = str(e)
-        if "404" in error_msg or "not found" in error_msg.lower():
-            print("✗ NOT FOUND")
-        else:
-            print(f"✗ ERROR: {error_msg[:60]}")
+                await test_model(model, api)
+                return True, True, f"✓ Works ({api})"
+            except api_exceptions.NotFound:
+                return False, False, "✗ NOT FOUND"
+            except RETRYABLE_ERRORS as e:
+                if attempt == PROBE_ATTEMPTS - 1:
+                    return True, False, f"✗ Test failed: {type(e).__name__}"
+                await asyncio.sleep(2 ** attempt)
+            except api_exceptions.GoogleAPICallError as e:
+                return True, False, f"✗ Test failed: {e.message[:50]}"
+
+async def probe_all(fast: bool):
+    slots = asyncio.Semaphore(PROBE_CONCURRENCY)
+    available_models = []
+    working_models = []  # Models that actually work (not just exist)
+    
+    def record(model_name, found, works, status):
+        print(f"  {model_name}: {status}")
+        if found:
+            available_models.append(model_name)
+        if works:
+            working_models.append(model_name)
+    
+    if fast:
+        # One call at a time in recommendation order (Flash first), stopping at the first that
+        # works, so no request is sent for models that wouldn't be recommended anyway
+        ordered = sorted(model_names, key=lambda name: 'flash' not in name.lower())
+        for model_name in ordered:
+            found, works, status = await probe(model_name, slots)
+            record(model_name, found, works, status)
+            if works:
+                break
+        return available_models, working_models
+    
+    tasks = [asyncio.create_task(probe(name, slots)) for name in model_names]
+    try:
+        # Report in list order so the output (and the recommendation) doesn't depend on timing
+        for model_name, task in zip(model_names, tasks):
+            record(model_name, *(await task))
+    finally:
+        for task in tasks:
+            task.cancel()
+    return available_models, working_models
+
+def probe_models(fast: bool):
+    """Test the model names (concurrently, or one by one with fast); return (found, working) names."""
+    # Initialize Vertex AI
+    aiplatform.init(project=PROJECT_ID, location=REGION)
+
+    print("\nTrying GenerativeModel() with various names (modern API):\n")
+    return asyncio.run(probe_all(fast))
+
+cache_file = cache_path(PROJECT_ID, REGION)
+cached = None if "--refresh" in sys.argv else read_cache(cache_file, CACHE_KEY, FAST)
+if cached is not None:
+    available_models, working_models = cached["available"], cached["working"]
+    print(f"\nUsing cached results from {cache_file} (--refresh to probe again)")
+else:
+    available_models, working_models = probe_models(FAST)
+    if working_models:  # Don't cache a failure; the next run should probe again
+        write_cache(cache_file, CACHE_KEY, FAST, available=available_models, working=working_models)
 
 print("\n" + "=" * 60)
 if working_models:
@@ -91,9 +166,16 @@ if working_models:
         recommended = flash_models[0]  # First Flash model
         print(f"\n💡 Recommended for RAG: '{recommended}' (Flash models are faster and cheaper for document Q&A)")
     else:
-        print(f"\n💡 Recommended: '{working_models[0]}'")
+        recommended = working_models[0]
+        print(f"\n💡 Recommended: '{recommended}'")
+    
+    if "--write-cache" in sys.argv:
+        args = [a for a in sys.argv[sys.argv.index("--write-cache") + 1:] if not a.startswith("--")]
+        out_path = Path(args[0]) if args else Path(__file__).resolve().parent.parent / ".model_cache"
+        out_path.write_text(recommended + "\n", encoding="utf-8")
+        print(f"   Saved to {out_path} (used by the RAG service at startup)")
 elif available_models:
-    print(f"\n⚠ Models loaded but chat test failed: {', '.join(available_models)}")
+    print(f"\n⚠ Models found but test call failed: {', '.join(available_models)}")
     print("   These models may not be available in your region or may need different configuration")
 else:
     print("\n✗ No Gemini models found!")
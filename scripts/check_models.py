@@ -2,24 +2,21 @@
 """
 Check available embedding models in your Vertex AI region.
 Run this to see which models are available before using them.
+
+Results are cached in ~/.cache/uplifted-mascot for 24 hours; pass --refresh to probe
+again. With --fast, probing stops at the first model that works.
 """
 
 import os
 import sys
 from google.cloud import aiplatform
 from vertexai.language_models import TextEmbeddingModel
+from probe_cache import cache_path, read_cache, write_cache
 
-def check_models(project_id: str, region: str = "us-east1"):
-    """
-    Try to load different embedding models to see which are available.
-    
-    Args:
-        project_id: GCP project ID
-        region: GCP region to check
-    """
-    print(f"Checking available embedding models in {region}...")
-    print(f"Project: {project_id}\n")
-    
+CACHE_KEY = "embedding"
+
+def probe_models(project_id: str, region: str, fast: bool = False):
+    """Load each embedding model and embed a test string; return the names that work."""
     # Initialize Vertex AI
     aiplatform.init(project=project_id, location=region)
     
@@ -42,9 +39,36 @@ def check_models(project_id: str, region: str = "us-east1"):
             test_embedding = model.get_embeddings(["test"])[0]
             print(f"✓ Available (dimensions: {len(test_embedding.values)})")
             available_models.append(model_name)
+            if fast:
+                break
         except Exception as e:
             print(f"✗ Not available: {str(e)[:60]}")
     
+    return available_models
+
+def check_models(project_id: str, region: str = "us-east1", fast: bool = False, refresh: bool = False):
+    """
+    Try to load different embedding models to see which are available.
+    
+    Args:
+        project_id: GCP project ID
+        region: GCP region to check
+        fast: Stop at the first model that works
+        refresh: Ignore cached results and probe the API again
+    """
+    print(f"Checking available embedding models in {region}...")
+    print(f"Project: {project_id}\n")
+    
+    cache_file = cache_path(project_id, region)
+    cached = None if refresh else read_cache(cache_file, CACHE_KEY, fast)
+    if cached is not None:
+        available_models = cached["models"]
+        print(f"Using cached results from {cache_file} (--refresh to probe again)")
+    else:
+        available_models = probe_models(project_id, region, fast)
+        if available_models:
+            write_cache(cache_file, CACHE_KEY, fast, models=available_models)
+    
     print(f"\n{'='*60}")
     if available_models:
         print(f"Available models in {region}:")
@@ -59,16 +83,17 @@ def check_models(project_id: str, region: str = "us-east1"):
         print("  3. Region supports the models")
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    if not args:
         project_id = os.environ.get("GCP_PROJECT_ID")
         if not project_id:
-            print("Usage: python check_models.py <project_id> [region]")
+            print("Usage: python check_models.py <project_id> [region] [--fast] [--refresh]")
             print("Or set GCP_PROJECT_ID environment variable")
             sys.exit(1)
     else:
-        project_id = sys.argv[1]
+        project_id = args[0]
     
-    region = sys.argv[2] if len(sys.argv) > 2 else "us-east1"
+    region = args[1] if len(args) > 1 else "us-east1"
     
-    check_models(project_id, region)
+    check_models(project_id, region, fast="--fast" in sys.argv, refresh="--refresh" in sys.argv)
 
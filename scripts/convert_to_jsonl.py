@@ -5,6 +5,25 @@ Convert embeddings JSON to JSONL format for Vector Search.
 
 import json
 from pathlib import Path
+import numpy as np
+from embedding_io import iter_json_array, orjson, record_embedding
+
+def split_record(line: bytes):
+    """
+    Split one record line into (record without its vector, the vector's raw JSON bytes).
+    
+    create_embeddings.py writes "embedding" as the last key and JSON strings can't contain
+    a bare quote, so the float list is the tail after the last '"embedding":'. It is
+    copied through as-is instead of being parsed into floats and formatted again. Returns
+    (record, None) for lines in any other shape, e.g. f16/int8 records.
+    """
+    loads = orjson.loads if orjson is not None else json.loads
+    at = line.rfind(b'"embedding":')
+    head = line[:at].rstrip()
+    embedding = line[at + len(b'"embedding":'):-1].strip()
+    if at < 0 or not head.endswith(b",") or not line.endswith(b"}") or not (embedding.startswith(b"[") and embedding.endswith(b"]")):
+        return loads(line), None
+    return loads(head[:-1] + b"}"), embedding
 
 def convert_to_jsonl(embeddings_file: str, output_file: str):
     """
@@ -15,36 +34,39 @@ def convert_to_jsonl(embeddings_file: str, output_file: str):
     - embedding: The vector
     - metadata: Additional data (restricts to string values)
     """
-    with open(embeddings_file, 'r', encoding='utf-8') as f:
-        embeddings_data = json.load(f)
+    print(f"Converting {embeddings_file} to JSONL...")
     
-    print(f"Converting {len(embeddings_data)} embeddings to JSONL...")
-    
-    with open(output_file, 'w', encoding='utf-8') as f:
-        for idx, item in enumerate(embeddings_data):
+    if orjson is not None:
+        dumps = lambda obj: orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    else:
+        dumps = lambda obj: json.dumps(obj.tolist() if isinstance(obj, np.ndarray) else obj).encode('utf-8')
+    count = 0
+    with open(output_file, 'wb') as f:
+        for element in iter_json_array(embeddings_file, raw=True):
+            item, embedding = split_record(element) if isinstance(element, bytes) else (element, None)
+            if embedding is None:
+                # Vector Search needs float lists, so f16/int8 records are decoded
+                embedding = dumps(item["embedding"] if "embedding" in item else record_embedding(item))
+            
             # Create unique ID
             file_path = item["metadata"]["file_path"]
             chunk_idx = item["metadata"]["chunk_index"]
-            doc_id = f"{file_path}:{chunk_idx}"
-            
-            # Vector Search JSONL format
-            jsonl_item = {
-                "id": doc_id,
-                "embedding": item["embedding"]
-            }
+            doc_id = item.get("id") or f"{file_path}:{chunk_idx}"
             
             # Add metadata (must be strings)
-            jsonl_item["metadata"] = {
+            metadata = {
                 "file_path": str(item["metadata"]["file_path"]),
                 "filename": str(item["metadata"]["filename"]),
                 "chunk_index": str(item["metadata"]["chunk_index"]),
                 "text": item["text"][:500]  # First 500 chars for reference
             }
             
-            f.write(json.dumps(jsonl_item) + '\n')
+            # Vector Search JSONL format: {"id", "embedding", "metadata"}, vector spliced in as-is
+            f.write(b'{"id":' + dumps(doc_id) + b',"embedding":' + embedding + b',"metadata":' + dumps(metadata) + b'}\n')
+            count += 1
     
     print(f"Converted to: {Path(output_file).absolute()}")
-    print(f"Lines: {len(embeddings_data)}")
+    print(f"Lines: {count}")
 
 if __name__ == "__main__":
     import sys
@@ -4,19 +4,266 @@ Create embeddings for document chunks using Vertex AI.
 """
 
 import os
+import base64
+import hashlib
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+import numpy as np
+from google.api_core import exceptions as api_exceptions
 from google.cloud import aiplatform
-from vertexai.language_models import TextEmbeddingModel
+from vertexai.language_models import TextEmbeddingModel, TextEmbeddingInput
+from embedding_io import load_json, orjson
 
-def create_embeddings(chunks_file: str, output_file: str = "embeddings-array.json"):
+# Output dimensionality - must match EMBED_DIM in the RAG service (unset = model default, 768)
+EMBED_DIM = int(os.environ["EMBED_DIM"]) if os.environ.get("EMBED_DIM") else None
+
+# Per-request limits of the embedding API: 250 inputs (5 for textembedding-gecko@001) and 20k tokens
+MAX_BATCH_INPUTS = 250
+MAX_BATCH_TOKENS = 20000
+MAX_RETRIES = 5  # Attempts per batch on quota/availability errors, with exponential backoff
+# Batches in flight at once; requests are network-bound, so threads overlap them
+EMBED_WORKERS = int(os.environ.get("EMBED_WORKERS", "10"))
+
+# Vertex AI Batch Prediction (about half the price of online calls) is opt-in: used for corpora of
+# at least BATCH_MODE_MIN_CHUNKS chunks when EMBED_BATCH_BUCKET is set, or always with --batch-mode
+# (which can also stage in BUCKET_NAME, the Vector Search bucket, when EMBED_BATCH_BUCKET isn't set)
+EMBED_BATCH_BUCKET = os.environ.get("EMBED_BATCH_BUCKET")
+BATCH_BUCKET = EMBED_BATCH_BUCKET or os.environ.get("BUCKET_NAME")
+BATCH_MODE_MIN_CHUNKS = int(os.environ.get("BATCH_MODE_MIN_CHUNKS", "2000"))
+BATCH_POLL_MAX_SECONDS = 300
+RETRYABLE_ERRORS = (api_exceptions.ResourceExhausted, api_exceptions.ServiceUnavailable)
+
+# How vectors are stored in the output file: "f32" (float lists), or base64 "f16" / "int8"
+# at 1/2 and 1/4 the size; load_chromadb.py and convert_to_jsonl.py decode all three
+EMBED_STORE_DTYPE = os.environ.get("EMBED_STORE_DTYPE", "f32")
+STORE_DTYPES = ("f32", "f16", "int8")
+
+def make_batches(chunks_data: list, max_inputs: int, max_tokens: int = MAX_BATCH_TOKENS) -> list:
+    """
+    Split chunks into consecutive batches within the per-request input and token caps.
+    
+    Tokens are estimated as len(text) // 4; a single oversized chunk still gets its own batch.
+    """
+    batches = []
+    batch, batch_tokens = [], 0
+    for item in chunks_data:
+        tokens = len(item["text"]) // 4 + 1
+        if batch and (len(batch) >= max_inputs or batch_tokens + tokens > max_tokens):
+            batches.append(batch)
+            batch, batch_tokens = [], 0
+        batch.append(item)
+        batch_tokens += tokens
+    if batch:
+        batches.append(batch)
+    return batches
+
+def dedupe_chunks(chunks_data: list):
+    """
+    Find chunks with identical text (license headers, nav, footers...) so each is embedded once.
+    
+    Returns (unique chunks in first-seen order, for each chunk the index of its unique one).
+    """
+    first_seen = {}
+    unique = []
+    slots = []
+    for item in chunks_data:
+        digest = hashlib.blake2b(item["text"].encode("utf-8"), digest_size=16).digest()
+        if digest not in first_seen:
+            first_seen[digest] = len(unique)
+            unique.append(item)
+        slots.append(first_seen[digest])
+    return unique, slots
+
+def fan_out(chunks_data: list, slots: list, unique_records):
+    """
+    Yield (chunk, vector) for every chunk from the (unique chunk, vector) stream, in chunk order.
+    
+    A chunk's unique text is never first seen after the chunk itself, so each chunk can be
+    written as soon as its vector arrives; vectors are dropped after their last use.
+    """
+    last_use = {slot: i for i, slot in enumerate(slots)}
+    vectors = []
+    i = 0
+    for _, vector in unique_records:
+        vectors.append(vector)
+        while i < len(slots) and slots[i] < len(vectors):
+            yield chunks_data[i], vectors[slots[i]]
+            if last_use[slots[i]] == i:
+                vectors[slots[i]] = None
+            i += 1
+
+def normalize_rows(vectors) -> np.ndarray:
+    """
+    Scale each vector to unit length, in one vectorized pass over the batch.
+    
+    With unit vectors a dot product is the cosine similarity, so DOT_PRODUCT_DISTANCE indexes
+    and Chroma's l2/ip spaces all rank like cosine. Kept in float64 so the plain-json output
+    matches what the API returned; write_embeddings narrows to float32 when orjson is used.
+    """
+    matrix = np.array(vectors, dtype=np.float64)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True).clip(min=1e-12)
+    return matrix
+
+def embed_batch(model, batch: list) -> list:
+    """Embed one batch, backing off and retrying when the API is out of quota or unavailable."""
+    # Corpus side of asymmetric retrieval; the RAG service embeds questions as RETRIEVAL_QUERY
+    texts = [TextEmbeddingInput(text=item["text"], task_type="RETRIEVAL_DOCUMENT") for item in batch]
+    for attempt in range(MAX_RETRIES):
+        try:
+            return model.get_embeddings(texts, output_dimensionality=EMBED_DIM)
+        except RETRYABLE_ERRORS as e:
+            if attempt == MAX_RETRIES - 1:
+                raise
+            delay = 2 ** attempt
+            print(f"  {type(e).__name__}, retrying in {delay}s...")
+            time.sleep(delay)
+
+def embed_online(model, chunks_data: list, max_inputs: int):
+    """
+    Embed chunks with concurrent online requests, yielding (chunk, vector) in chunk order.
+    
+    Batches finishing early are held only until the batches before them are done, so
+    results can be written out while later batches are still running. Chunks of a
+    batch that failed come back with a None vector.
+    """
+    # Batches as large as the API allows, EMBED_WORKERS at a time; quota errors back off
+    batches = make_batches(chunks_data, max_inputs)
+    finished = {}
+    next_batch = 0
+    
+    with ThreadPoolExecutor(max_workers=max(EMBED_WORKERS, 1)) as executor:
+        futures = {executor.submit(embed_batch, model, batch): n for n, batch in enumerate(batches)}
+        for done, future in enumerate(as_completed(futures), 1):
+            n = futures[future]
+            try:
+                finished[n] = future.result()
+                print(f"Processed batch {n + 1} ({done}/{len(batches)} done, {len(batches[n])} chunks)")
+            except Exception as e:
+                finished[n] = None
+                print(f"Error in batch {n + 1}: {e}")
+            while next_batch in finished:
+                embeddings = finished.pop(next_batch)
+                if embeddings is not None:
+                    vectors = normalize_rows([embedding.values for embedding in embeddings])
+                    yield from zip(batches[next_batch], vectors)
+                else:
+                    yield from ((item, None) for item in batches[next_batch])
+                next_batch += 1
+
+def encode_embedding(vector, dtype: str) -> dict:
+    """
+    Record fields holding one vector in the given storage dtype.
+    
+    int8 keeps a per-vector scale (max |value| / 127), so decoding is quantized * scale.
+    Both binary encodings are little-endian base64 strings.
+    """
+    if dtype == "f16":
+        return {"embedding_f16": base64.b64encode(np.asarray(vector, dtype="<f2").tobytes()).decode("ascii")}
+    if dtype == "int8":
+        vector = np.asarray(vector, dtype=np.float32)
+        scale = float(np.abs(vector).max()) / 127 or 1.0
+        quantized = np.round(vector / scale).astype(np.int8)
+        return {"embedding_i8": base64.b64encode(quantized.tobytes()).decode("ascii"), "embedding_scale": scale}
+    if orjson is not None:
+        return {"embedding": np.asarray(vector, dtype=np.float32)}
+    return {"embedding": np.asarray(vector).tolist()}
+
+def write_embeddings(output_file: str, records, dtype: str = EMBED_STORE_DTYPE) -> int:
+    """
+    Write (chunk, unit vector) pairs as a JSON array, one compact record per line, as they arrive.
+    
+    Nothing is buffered, so peak memory no longer grows with the corpus. With orjson,
+    "f32" vectors are written as float32 (what ChromaDB stores), whose shortest repr is about
+    40% fewer bytes than float64's; see encode_embedding for the "f16" and "int8" fields.
+    Returns the number of records written.
+    """
+    if dtype not in STORE_DTYPES:
+        raise ValueError(f"Unknown embedding dtype {dtype!r}, expected one of {', '.join(STORE_DTYPES)}")
+    count = 0
+    with open(output_file, 'wb') as f:
+        f.write(b"[")
+        for item, vector in records:
+            if vector is None:
+                continue
+            f.write(b",\n" if count else b"\n")
+            record = {"text": item["text"], "metadata": item["metadata"], **encode_embedding(vector, dtype)}
+            if "id" in item:
+                record = {"id": item["id"], **record}
+            if orjson is not None:
+                f.write(orjson.dumps(record, option=orjson.OPT_SERIALIZE_NUMPY))
+            else:
+                f.write(json.dumps(record).encode("utf-8"))
+            count += 1
+        f.write(b"\n]\n")
+    return count
+
+def embed_with_batch_job(chunks_data: list, model_name: str, bucket_name: str) -> list:
+    """
+    Embed chunks with a Vertex AI batch prediction job staged in gs://<bucket_name>/embedding-batches/.
+    
+    The job doesn't keep input order, so predictions are matched back by text; chunks with
+    the same text get the same vector anyway. Returns (chunk, vector) pairs, with None for
+    chunks the job didn't embed.
+    """
+    from google.cloud import storage
+    
+    run = time.strftime("%Y%m%d-%H%M%S")
+    prefix = f"embedding-batches/{run}"
+    texts = list(dict.fromkeys(item["text"] for item in chunks_data))
+    lines = "\n".join(json.dumps({"content": text, "task_type": "RETRIEVAL_DOCUMENT"}) for text in texts)
+    storage.Client().bucket(bucket_name).blob(f"{prefix}/input.jsonl").upload_from_string(
+        lines, content_type="application/jsonl"
+    )
+    print(f"Uploaded {len(texts)} texts to gs://{bucket_name}/{prefix}/input.jsonl")
+    
+    job = aiplatform.BatchPredictionJob.create(
+        job_display_name=f"um-embeddings-{run}",
+        model_name=f"publishers/google/models/{model_name}",
+        gcs_source=f"gs://{bucket_name}/{prefix}/input.jsonl",
+        gcs_destination_prefix=f"gs://{bucket_name}/{prefix}/output",
+        model_parameters={"outputDimensionality": EMBED_DIM} if EMBED_DIM else None,
+        sync=False,
+    )
+    job.wait_for_resource_creation()
+    print(f"Started batch prediction job {job.resource_name}")
+    
+    # Jobs take minutes; poll with a growing interval instead of blocking on a fixed one
+    delay = 10
+    while not job.done():
+        time.sleep(delay)
+        delay = min(delay * 2, BATCH_POLL_MAX_SECONDS)
+        print(f"  job state: {job.state.name}")
+    if job.state.name != "JOB_STATE_SUCCEEDED":
+        raise RuntimeError(f"Batch prediction job failed ({job.state.name}): {job.error}")
+    
+    by_text = {}
+    for blob in job.iter_outputs():
+        if not blob.name.endswith(".jsonl"):
+            continue
+        for line in blob.download_as_text().splitlines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            predictions = record.get("predictions") or []
+            if predictions and not record.get("status"):
+                by_text[record["instance"]["content"]] = predictions[0]["embeddings"]["values"]
+    print(f"Batch prediction returned {len(by_text)}/{len(texts)} embeddings")
+    if by_text:
+        by_text = dict(zip(by_text, normalize_rows(list(by_text.values()))))
+    return [(item, by_text.get(item["text"])) for item in chunks_data]
+
+def create_embeddings(chunks_file: str, output_file: str = "embeddings-array.json", batch_mode: bool = None,
+                      dtype: str = EMBED_STORE_DTYPE):
     """
     Create embeddings for all chunks.
     
     Args:
         chunks_file: JSON file with chunks (from process_docs.py)
         output_file: Output file for embeddings
+        batch_mode: Use a Vertex AI batch prediction job (None = only for large corpora
+            when EMBED_BATCH_BUCKET is set)
     """
     # Initialize Vertex AI
     PROJECT_ID = os.environ.get("GCP_PROJECT_ID")
@@ -28,21 +275,29 @@ def create_embeddings(chunks_file: str, output_file: str = "embeddings-array.jso
     aiplatform.init(project=PROJECT_ID, location=LOCATION)
     
     # Load chunks
-    with open(chunks_file, 'r', encoding='utf-8') as f:
-        chunks_data = json.load(f)
+    chunks_data = load_json(chunks_file)
+    unique_chunks, slots = dedupe_chunks(chunks_data)
     
     print(f"Creating embeddings for {len(chunks_data)} chunks...")
+    if len(unique_chunks) < len(chunks_data):
+        duplicates = len(chunks_data) - len(unique_chunks)
+        print(f"  {duplicates} duplicate chunks ({duplicates / len(chunks_data):.0%}) reuse another chunk's embedding")
     
     # Initialize embedding model
     # Try text-embedding-004 first (available in us-east1), fall back to gecko models
+    max_inputs = MAX_BATCH_INPUTS
     try:
-        model = TextEmbeddingModel.from_pretrained("text-embedding-004")
+        model_name = "text-embedding-004"
+        model = TextEmbeddingModel.from_pretrained(model_name)
     except Exception:
         try:
-            model = TextEmbeddingModel.from_pretrained("textembedding-gecko@003")
+            model_name = "textembedding-gecko@003"
+            model = TextEmbeddingModel.from_pretrained(model_name)
         except Exception:
             try:
-                model = TextEmbeddingModel.from_pretrained("textembedding-gecko@001")
+                model_name = "textembedding-gecko@001"
+                model = TextEmbeddingModel.from_pretrained(model_name)
+                max_inputs = 5
             except Exception as e:
                 print(f"Error loading embedding model: {e}")
                 print("Available models may vary by region. Try:")
@@ -51,49 +306,43 @@ def create_embeddings(chunks_file: str, output_file: str = "embeddings-array.jso
                 print("  - textembedding-gecko@001")
                 raise
     
-    # Process in batches (API has rate limits)
-    batch_size = 5
-    embeddings_data = []
-    
-    for i in range(0, len(chunks_data), batch_size):
-        batch = chunks_data[i:i+batch_size]
-        texts = [item["text"] for item in batch]
-        
-        print(f"Processing batch {i//batch_size + 1}/{(len(chunks_data)-1)//batch_size + 1}")
-        
-        try:
-            # Create embeddings
-            embeddings = model.get_embeddings(texts)
-            
-            # Combine with metadata
-            for item, embedding in zip(batch, embeddings):
-                embeddings_data.append({
-                    "text": item["text"],
-                    "metadata": item["metadata"],
-                    "embedding": embedding.values
-                })
-            
-            # Rate limiting
-            time.sleep(0.5)
-        
-        except Exception as e:
-            print(f"Error in batch {i//batch_size + 1}: {e}")
-            continue
+    if batch_mode is None:
+        batch_mode = bool(EMBED_BATCH_BUCKET) and len(unique_chunks) >= BATCH_MODE_MIN_CHUNKS
+    if batch_mode:
+        if not BATCH_BUCKET:
+            raise ValueError("--batch-mode needs EMBED_BATCH_BUCKET (or BUCKET_NAME) for staging files")
+        records = embed_with_batch_job(unique_chunks, model_name, BATCH_BUCKET)
+    else:
+        records = embed_online(model, unique_chunks, max_inputs)
+    records = fan_out(chunks_data, slots, records)
     
-    # Save embeddings
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(embeddings_data, f, indent=2)
+    # Save embeddings, in the original chunk order, as they're produced
+    count = write_embeddings(output_file, records, dtype)
     
-    print(f"\nCreated {len(embeddings_data)} embeddings")
+    print(f"\nCreated {count} embeddings")
     print(f"Saved to: {Path(output_file).absolute()}")
     
-    return embeddings_data
+    return count
 
 if __name__ == "__main__":
     import sys
     
-    if len(sys.argv) < 2:
-        print("Usage: python create_embeddings.py <chunks_file> [output_file]")
+    batch_mode = None
+    if "--batch-mode" in sys.argv:
+        sys.argv.remove("--batch-mode")
+        batch_mode = True
+    dtype = EMBED_STORE_DTYPE
+    if "--dtype" in sys.argv:
+        i = sys.argv.index("--dtype")
+        dtype = sys.argv[i + 1] if i + 1 < len(sys.argv) else ""
+        del sys.argv[i:i + 2]
+    
+    if len(sys.argv) < 2 or dtype not in STORE_DTYPES:
+        print("Usage: python create_embeddings.py <chunks_file> [output_file] [--batch-mode] [--dtype f32|f16|int8]")
+        print("\n  --batch-mode  Embed via a Vertex AI batch prediction job (needs EMBED_BATCH_BUCKET or BUCKET_NAME);")
+        print(f"                used automatically from {BATCH_MODE_MIN_CHUNKS} chunks when EMBED_BATCH_BUCKET is set")
+        print("  --dtype       How vectors are stored (default: EMBED_STORE_DTYPE or f32); f16 halves and")
+        print("                int8 quarters the file, at a small cost in retrieval precision")
         sys.exit(1)
     
     if not os.environ.get("GCP_PROJECT_ID"):
@@ -104,5 +353,5 @@ if __name__ == "__main__":
     # Default to embeddings-array.json to avoid conflict with JSONL output
     output_file = sys.argv[2] if len(sys.argv) > 2 else "embeddings-array.json"
     
-    create_embeddings(chunks_file, output_file)
+    create_embeddings(chunks_file, output_file, batch_mode, dtype)
 
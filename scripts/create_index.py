@@ -1,14 +1,51 @@
 #!/usr/bin/env python3
 """
 Create a Vector Search index in Vertex AI.
+
+The tree-AH parameters are sized for the corpus: pass --corpus-size N, or the vectors in the
+bucket's top-level .json files are counted.
 """
 
+import math
 import os
 import json
 from google.cloud import aiplatform
-from vertexai.preview import vector_search
 
-def create_vector_index(project_id: str, region: str, bucket_name: str):
+# Shard size of the index's serving nodes: SHARD_SIZE_SMALL, SHARD_SIZE_MEDIUM or SHARD_SIZE_LARGE
+SHARD_SIZE = os.environ.get("INDEX_SHARD_SIZE", "SHARD_SIZE_SMALL")
+
+def count_vectors(bucket_name: str) -> int:
+    """
+    Count the vectors in the bucket's top-level .json files (what contentsDeltaUri reads).
+
+    Each non-blank line is one record, and that includes a last record with no trailing newline.
+    """
+    from google.cloud import storage
+    
+    count = 0
+    for blob in storage.Client().list_blobs(bucket_name):
+        if "/" in blob.name or not blob.name.endswith(".json"):
+            continue
+        with blob.open("rb") as f:
+            count += sum(1 for line in f if line.strip())
+    return count
+
+def tree_ah_config(corpus_size: int) -> dict:
+    """
+    Rule-of-thumb tree-AH settings for a corpus of corpus_size vectors.
+    
+    Leaves grow with sqrt(N) (at least 500 vectors each), and the share of leaves searched
+    shrinks as the corpus grows, between 2% and 20%: searching more leaves raises recall at
+    the cost of query latency, which small corpora can afford and large ones can't.
+    """
+    n = max(corpus_size, 1)
+    return {
+        "leafNodeEmbeddingCount": max(500, int(math.sqrt(n) * 10)),
+        "leafNodesToSearchPercent": int(min(max(100 * math.sqrt(n) / n * 20, 2), 20)),
+    }
+
+def create_vector_index(project_id: str, region: str, bucket_name: str, corpus_size: int = None,
+                        shard_size: str = SHARD_SIZE):
     """
     Create a Vector Search index.
     
@@ -16,10 +53,16 @@ def create_vector_index(project_id: str, region: str, bucket_name: str):
         project_id: GCP project ID
         region: GCP region (e.g., us-east1)
         bucket_name: Cloud Storage bucket with embeddings
+        corpus_size: Number of vectors, used to size the tree-AH settings (counted if None)
+        shard_size: Serving shard size (SHARD_SIZE_SMALL, _MEDIUM or _LARGE)
     """
     # Initialize Vertex AI
     aiplatform.init(project=project_id, location=region)
     
+    if corpus_size is None:
+        corpus_size = count_vectors(bucket_name)
+        print(f"Found {corpus_size} vectors in gs://{bucket_name}/")
+    
     # Index configuration
     index_config = {
         "displayName": "uplifted-mascot-index",
@@ -27,34 +70,38 @@ def create_vector_index(project_id: str, region: str, bucket_name: str):
         "metadata": {
             "contentsDeltaUri": f"gs://{bucket_name}/",
             "config": {
-                "dimensions": 768,  # textembedding-gecko@001 produces 768-dim vectors
+                "dimensions": int(os.environ.get("EMBED_DIM", "768")),  # Must match create_embeddings.py (768 = model default)
                 "approximateNeighborsCount": 10,
                 "distanceMeasureType": "DOT_PRODUCT_DISTANCE",
                 "algorithmConfig": {
-                    "treeAhConfig": {
-                        "leafNodeEmbeddingCount": 500,
-                        "leafNodesToSearchPercent": 5
-                    }
-                }
+                    "treeAhConfig": tree_ah_config(corpus_size)
+                },
+                "shardSize": shard_size
             }
         }
     }
+    config = index_config["metadata"]["config"]
+    tree_ah = config["algorithmConfig"]["treeAhConfig"]
     
     print(f"Creating index in project {project_id}, region {region}...")
     print(f"Using bucket: gs://{bucket_name}/")
+    print(f"Tree-AH config: {json.dumps(tree_ah)}, {shard_size}")
     
     # Create index
     # Note: This is a long-running operation (can take 30+ minutes)
-    index = vector_search.create_index(
+    index = aiplatform.MatchingEngineIndex.create_tree_ah_index(
         display_name=index_config["displayName"],
         contents_delta_uri=index_config["metadata"]["contentsDeltaUri"],
-        dimensions=index_config["metadata"]["config"]["dimensions"],
-        approximate_neighbors_count=index_config["metadata"]["config"]["approximateNeighborsCount"],
-        distance_measure_type=index_config["metadata"]["config"]["distanceMeasureType"],
+        dimensions=config["dimensions"],
+        approximate_neighbors_count=config["approximateNeighborsCount"],
+        distance_measure_type=config["distanceMeasureType"],
+        leaf_node_embedding_count=tree_ah["leafNodeEmbeddingCount"],
+        leaf_nodes_to_search_percent=tree_ah["leafNodesToSearchPercent"],
+        shard_size=config["shardSize"],
         description=index_config["description"]
     )
     
-    print(f"Index created: {index.name}")
+    print(f"Index created: {index.display_name}")
     print(f"Index ID: {index.resource_name}")
     
     return index
@@ -62,13 +109,25 @@ def create_vector_index(project_id: str, region: str, bucket_name: str):
 if __name__ == "__main__":
     import sys
     
+    corpus_size = None
+    if "--corpus-size" in sys.argv:
+        i = sys.argv.index("--corpus-size")
+        corpus_size = int(sys.argv[i + 1])
+        del sys.argv[i:i + 2]
+    shard_size = SHARD_SIZE
+    if "--shard-size" in sys.argv:
+        i = sys.argv.index("--shard-size")
+        shard_size = sys.argv[i + 1]
+        del sys.argv[i:i + 2]
+    
     if len(sys.argv) < 4:
-        print("Usage: python create_index.py <project_id> <region> <bucket_name>")
+        print("Usage: python create_index.py <project_id> <region> <bucket_name> [--corpus-size N] [--shard-size SIZE]")
+        print("\n  --corpus-size  Number of vectors (default: count the bucket's top-level .json files)")
+        print("  --shard-size   SHARD_SIZE_SMALL (default, or INDEX_SHARD_SIZE), SHARD_SIZE_MEDIUM or SHARD_SIZE_LARGE")
         sys.exit(1)
     
     project_id = sys.argv[1]
     region = sys.argv[2]
     bucket_name = sys.argv[3]
     
-    create_index(project_id, region, bucket_name)
-
+    create_vector_index(project_id, region, bucket_name, corpus_size, shard_size)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Reading chunk and embedding files, shared by the ingestion scripts.
+
+create_embeddings.py, load_chromadb.py and convert_to_jsonl.py import these helpers
+(the scripts directory is on sys.path when a script is run directly).
+"""
+
+import base64
+import json
+import mmap
+import os
+import numpy as np
+
+try:
+    import orjson
+except ImportError:  # Optional: several times faster on multi-MB embedding files
+    orjson = None
+
+def load_json(path: str):
+    """
+    Parse a JSON file (or a .jsonl file of one record per line), with orjson when it's installed.
+
+    orjson parses straight from a read-only memory map, so the raw file is paged in by
+    the OS instead of being copied onto the heap next to the parsed objects.
+    """
+    if path.endswith(".jsonl"):
+        loads = orjson.loads if orjson is not None else json.loads
+        with open(path, 'rb') as f:
+            return [loads(line) for line in f if line.strip()]
+    if orjson is not None:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return orjson.loads(b"")  # mmap can't map an empty file; raise the usual error
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as view:
+                    return orjson.loads(view)
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def iter_json_array(path: str, raw: bool = False):
+    """
+    Yield the elements of a JSON array file without holding the whole array in memory.
+
+    create_embeddings.py writes one element per line, which is streamed line by line
+    (as unparsed bytes with raw=True); any other layout (e.g. older indented files) falls
+    back to parsing the file whole and yields dicts.
+    """
+    loads = orjson.loads if orjson is not None else json.loads
+    with open(path, 'rb') as f:
+        if f.readline().strip() == b"[":
+            first_line = f.readline().rstrip().rstrip(b",")
+            try:
+                first = loads(first_line)
+            except ValueError:
+                first = None
+            if isinstance(first, dict):
+                yield first_line if raw else first
+                for line in f:
+                    line = line.rstrip().rstrip(b",")
+                    if line and line != b"]":
+                        yield line if raw else loads(line)
+                return
+    yield from load_json(path)
+
+def record_embedding(item: dict) -> np.ndarray:
+    """The record's vector as float32, whichever encoding create_embeddings.py stored it in."""
+    if "embedding_f16" in item:
+        return np.frombuffer(base64.b64decode(item["embedding_f16"]), dtype="<f2").astype(np.float32)
+    if "embedding_i8" in item:
+        quantized = np.frombuffer(base64.b64decode(item["embedding_i8"]), dtype=np.int8)
+        return quantized * np.float32(item["embedding_scale"])
+    return np.asarray(item["embedding"], dtype=np.float32)
@@ -5,10 +5,18 @@ This replaces Vertex AI Vector Search for small datasets.
 """
 
 import os
-import json
+import posixpath
 import chromadb
+import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from chromadb.config import Settings
+from embedding_io import iter_json_array, record_embedding
+
+# Rows per collection.add call; Chroma rejects calls above client.get_max_batch_size()
+ADD_BATCH_SIZE = 5000
+HTTP_ADD_WORKERS = 4  # Concurrent add requests against a ChromaDB server (local mode writes serially)
 
 def load_embeddings_to_chromadb(
     embeddings_file: str,
@@ -27,11 +35,7 @@ def load_embeddings_to_chromadb(
         chroma_host: ChromaDB service hostname (for HTTP client mode). If set, uses HTTP client.
         chroma_port: ChromaDB service port (default: 8000)
     """
-    # Load embeddings
-    with open(embeddings_file, 'r', encoding='utf-8') as f:
-        embeddings_data = json.load(f)
-    
-    print(f"Loading {len(embeddings_data)} embeddings into ChromaDB...")
+    print(f"Loading embeddings from {embeddings_file} into ChromaDB...")
     
     # Initialize ChromaDB client (HTTP mode if host provided, otherwise persistent mode)
     if chroma_host:
@@ -55,41 +59,71 @@ def load_embeddings_to_chromadb(
         metadata={"description": "Uplifted Mascot knowledge base embeddings"}
     )
     
-    # Prepare data for ChromaDB
-    # ChromaDB expects: ids, embeddings, documents, metadatas
-    ids = []
-    embeddings = []
-    documents = []
-    metadatas = []
-    
-    for item in embeddings_data:
-        # Create unique ID from metadata
-        file_path = item.get("metadata", {}).get("file_path", "")
-        chunk_index = item.get("metadata", {}).get("chunk_index", "")
-        doc_id = f"{file_path}:{chunk_index}"
-        
-        ids.append(doc_id)
-        embeddings.append(item["embedding"])
-        documents.append(item["text"])
-        
-        # Store metadata (ChromaDB requires metadata to be dict with string values)
-        metadata = {
-            "file_path": str(file_path),
-            "chunk_index": str(chunk_index),
-            "filename": str(item.get("metadata", {}).get("file_path", "").replace("\\", "/").split("/")[-1])
-        }
-        metadatas.append(metadata)
-    
-    # Add to collection (ChromaDB handles batching internally)
-    print("Adding embeddings to ChromaDB...")
-    collection.add(
-        ids=ids,
-        embeddings=embeddings,
-        documents=documents,
-        metadatas=metadatas
-    )
-    
-    print(f"✓ Successfully loaded {len(ids)} embeddings into ChromaDB")
+    # Records are streamed from the file into fixed-size batches, so memory holds one batch
+    # (per in-flight request) rather than the whole corpus; Chroma also rejects calls above
+    # client.get_max_batch_size()
+    batch_size = min(ADD_BATCH_SIZE, client.get_max_batch_size())
+    workers = HTTP_ADD_WORKERS if chroma_host else 1
+    print(f"Adding embeddings to ChromaDB in batches of up to {batch_size}...")
+    
+    def batches():
+        # ChromaDB expects: ids, embeddings, documents, metadatas. Embeddings go straight into a
+        # float32 matrix (what Chroma stores) instead of lists of boxed Python floats.
+        ids, documents, metadatas = [], [], []
+        embeddings = None
+        for item in iter_json_array(embeddings_file):
+            # Create unique ID from metadata, unless the record already carries one
+            item_metadata = item.get("metadata") or {}
+            file_path = item_metadata.get("file_path", "")
+            if not isinstance(file_path, str):
+                file_path = str(file_path)
+            chunk_index = item_metadata.get("chunk_index", "")
+            if not isinstance(chunk_index, str):
+                chunk_index = str(chunk_index)
+            doc_id = item.get("id") or f"{file_path}:{chunk_index}"
+            
+            vector = record_embedding(item)
+            if embeddings is None:
+                embeddings = np.empty((batch_size, len(vector)), dtype=np.float32)
+            embeddings[len(ids)] = vector
+            ids.append(doc_id)
+            documents.append(item["text"])
+            
+            # Store metadata (ChromaDB requires metadata to be dict with string values)
+            # filename is always stored so the RAG service never has to derive it per query
+            filename = item_metadata.get("filename") or posixpath.basename(file_path.replace("\\", "/"))
+            metadatas.append({
+                "file_path": file_path,
+                "chunk_index": chunk_index,
+                "filename": filename if isinstance(filename, str) else str(filename)
+            })
+            if len(ids) == batch_size:
+                yield ids, embeddings, documents, metadatas
+                # A new matrix per batch: the previous one may still be in flight
+                ids, documents, metadatas = [], [], []
+                embeddings = None
+        if ids:
+            yield ids, embeddings[:len(ids)], documents, metadatas
+    
+    def add_batch(batch) -> int:
+        ids, embeddings, documents, metadatas = batch
+        collection.add(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+        return len(ids)
+    
+    # A server indexes one batch while the next is read and sent; at most `workers` are pending
+    added = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for batch in batches():
+            pending.append(executor.submit(add_batch, batch))
+            while len(pending) >= workers:
+                added += pending.popleft().result()
+                print(f"  added {added}")
+        while pending:
+            added += pending.popleft().result()
+            print(f"  added {added}")
+    
+    print(f"✓ Successfully loaded {added} embeddings into ChromaDB")
     print(f"  Collection: {collection_name}")
     if chroma_host:
         print(f"  ChromaDB service: {chroma_host}:{chroma_port}")
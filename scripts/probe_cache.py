@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Cache of model probe results, shared by check_models.py and check_gemini_models.py.
+
+One JSON file per project and region in ~/.cache/uplifted-mascot, with one entry per
+script (keyed "embedding" and "gemini").
+"""
+
+import json
+import time
+from pathlib import Path
+
+# Probe results older than this are ignored and the models are checked again
+CACHE_TTL_SECONDS = 24 * 60 * 60
+
+def cache_path(project_id: str, region: str) -> Path:
+    return Path.home() / ".cache" / "uplifted-mascot" / f"models-{project_id}-{region}.json"
+
+def read_cache(path: Path, key: str, fast: bool):
+    """Return the cached entry for key, or None if missing, stale, or from a --fast run we can't use."""
+    try:
+        entry = json.loads(path.read_text(encoding="utf-8")).get(key)
+    except (OSError, ValueError):
+        return None
+    if not entry or time.time() - entry["checked_at"] > CACHE_TTL_SECONDS:
+        return None
+    if entry["fast"] and not fast:
+        return None  # A --fast run stopped early, so it doesn't list everything
+    return entry
+
+def write_cache(path: Path, key: str, fast: bool, **results):
+    """Store results under key, keeping the other script's entry."""
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        data = {}
+    data[key] = {"checked_at": time.time(), "fast": fast, **results}
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(data, indent=2), encoding="utf-8")
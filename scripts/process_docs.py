@@ -4,16 +4,42 @@ Simple document processor for Uplifted Mascot ingestion.
 Processes markdown files, chunks them, and creates embeddings.
 """
 
+import hashlib
 import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Optional
 import json
 
-def read_markdown_file(file_path: str) -> str:
-    """Read a markdown file and return its content."""
-    with open(file_path, 'r', encoding='utf-8') as f:
-        return f.read()
+try:
+    import orjson
+except ImportError:  # Optional: several times faster at serializing the chunk records
+    orjson = None
+
+# Compiled once; chunk_text runs for every file in the repository
+_RE_BLANKLINES = re.compile(r'\n{3,}')
+_RE_SENT_SPLIT = re.compile(r'[.!?]+\s+')
+
+# Directories and files whose name contains one of these are skipped
+SKIP_NAMES = ('.git', 'node_modules', 'CHANGELOG')
+# Only this many characters of a file are read and chunked (generated reports can be megabytes)
+MAX_FILE_CHARS = int(os.environ.get("MAX_FILE_CHARS", "2000000"))
+# Chunks whose text already appeared earlier (license headers, nav blocks...) are dropped; 0 keeps them
+DEDUPE_CHUNKS = os.environ.get("DEDUPE_CHUNKS", "1") != "0"
+
+def read_markdown_file(file_path: str, max_chars: int = -1) -> Optional[str]:
+    """
+    Read a markdown file and return its content (at most max_chars characters, if given).
+    
+    Returns None for binary files (a NUL in the first 4 KB). Invalid UTF-8 bytes are replaced
+    rather than raising, so one bad byte doesn't fail the whole file.
+    """
+    with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
+        head = f.read(4096 if max_chars < 0 else min(4096, max_chars))
+        if '\x00' in head:
+            return None
+        return head + f.read(-1 if max_chars < 0 else max_chars - len(head))
 
 def chunk_text(text: str, max_chunk_size: int = 1000, overlap: int = 200) -> List[str]:
     """
@@ -27,17 +53,15 @@ def chunk_text(text: str, max_chunk_size: int = 1000, overlap: int = 200) -> Lis
     Returns:
         List of text chunks
     """
-    # Remove excessive whitespace
-    text = re.sub(r'\n{3,}', '\n\n', text)
-    
-    # Split by paragraphs first (double newlines)
-    paragraphs = text.split('\n\n')
-    
     chunks = []
-    current_chunk = []
+    # Every paragraph (or sentence, for oversized paragraphs) in order; the chunk being built
+    # is always the range pieces[start:], so each chunk is joined exactly once, when emitted
+    pieces = []
+    start = 0
     current_size = 0
     
-    for para in paragraphs:
+    # Remove excessive whitespace, then split by paragraphs (double newlines)
+    for para in _RE_BLANKLINES.sub('\n\n', text).split('\n\n'):
         para = para.strip()
         if not para:
             continue
@@ -47,51 +71,75 @@ def chunk_text(text: str, max_chunk_size: int = 1000, overlap: int = 200) -> Lis
         # If single paragraph is too large, split by sentences
         if para_size > max_chunk_size:
             # Flush current chunk if exists
-            if current_chunk:
-                chunks.append('\n\n'.join(current_chunk))
-                current_chunk = []
-                current_size = 0
+            if start < len(pieces):
+                chunks.append('\n\n'.join(pieces[start:]))
+                start, current_size = len(pieces), 0
             
-            # Split large paragraph by sentences
-            sentences = re.split(r'[.!?]+\s+', para)
+            # Code blocks and tables often have no sentence terminators; skip the regex scan for those
+            if '.' in para or '!' in para or '?' in para:
+                sentences = _RE_SENT_SPLIT.split(para)
+            else:
+                sentences = [para]
             for sentence in sentences:
                 sentence = sentence.strip()
                 if not sentence:
                     continue
                 if current_size + len(sentence) > max_chunk_size:
-                    if current_chunk:
-                        chunks.append('\n\n'.join(current_chunk))
-                    current_chunk = [sentence]
-                    current_size = len(sentence)
+                    if start < len(pieces):
+                        chunks.append('\n\n'.join(pieces[start:]))
+                    start, current_size = len(pieces), len(sentence)
                 else:
-                    current_chunk.append(sentence)
                     current_size += len(sentence) + 2  # +2 for '\n\n'
-        else:
-            # Check if adding this paragraph would exceed limit
-            if current_size + para_size > max_chunk_size and current_chunk:
-                chunks.append('\n\n'.join(current_chunk))
-                # Start new chunk with overlap
-                if overlap > 0 and current_chunk:
-                    overlap_text = '\n\n'.join(current_chunk[-1:])
-                    current_chunk = [overlap_text, para]
-                    current_size = len(overlap_text) + para_size + 2
-                else:
-                    current_chunk = [para]
-                    current_size = para_size
+                pieces.append(sentence)
+        # Check if adding this paragraph would exceed limit
+        elif current_size + para_size > max_chunk_size and start < len(pieces):
+            chunks.append('\n\n'.join(pieces[start:]))
+            # Start new chunk with overlap: the previous chunk's last piece opens this one
+            if overlap > 0:
+                start = len(pieces) - 1
+                current_size = len(pieces[-1]) + para_size + 2
             else:
-                current_chunk.append(para)
-                current_size += para_size + 2
+                start, current_size = len(pieces), para_size
+            pieces.append(para)
+        else:
+            pieces.append(para)
+            current_size += para_size + 2
     
     # Add final chunk
-    if current_chunk:
-        chunks.append('\n\n'.join(current_chunk))
+    if start < len(pieces):
+        chunks.append('\n\n'.join(pieces[start:]))
     
     return chunks
 
-def extract_metadata(file_path: str, chunk_index: int, total_chunks: int) -> Dict:
-    """Extract metadata for a chunk."""
-    rel_path = os.path.relpath(file_path)
-    filename = os.path.basename(file_path)
+def iter_markdown_files(root: str):
+    """
+    Yield the paths of markdown files under root, in sorted order.
+    
+    Skipped directories are pruned with a single os.scandir pass per directory, so their
+    contents (e.g. .git objects, node_modules) are never listed at all.
+    """
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            entries = sorted(it, key=lambda entry: entry.name)
+        subdirs = []
+        for entry in entries:
+            if any(skip in entry.name for skip in SKIP_NAMES):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            elif entry.name.endswith('.md'):
+                yield entry.path
+        stack.extend(reversed(subdirs))
+
+def extract_metadata(rel_path: str, chunk_index: int, total_chunks: int, filename: str = None) -> Dict:
+    """
+    Extract metadata for a chunk of the file at rel_path (relative to the working directory).
+    
+    Pass filename when building records for many chunks of one file, so it's derived once.
+    """
+    if filename is None:
+        filename = os.path.basename(rel_path)
     
     return {
         "file_path": rel_path,
@@ -101,62 +149,124 @@ def extract_metadata(file_path: str, chunk_index: int, total_chunks: int) -> Dic
         "source": "github"  # Can be expanded later
     }
 
+def _process_one(md_file: str):
+    """
+    Read and chunk one markdown file in a worker process.
+    
+    Returns (chunk texts, note to append to the "Created N chunks" line), or (None, status
+    line) for a skipped file; the driver dedupes, builds the records and prints the status so
+    output stays in file order. Only the path goes to the worker and only the chunk strings come
+    back; relative paths and per-chunk records are the driver's.
+    """
+    try:
+        content = read_markdown_file(md_file, MAX_FILE_CHARS + 1)
+        if content is None:
+            return None, f"  Skipping (binary): {md_file}"
+        
+        # Skip very small files
+        if len(content) < 100:
+            return None, f"  Skipping (too small): {md_file}"
+        
+        # Cut oversized files at the last paragraph break within the limit
+        truncated = len(content) > MAX_FILE_CHARS
+        if truncated:
+            cut = content.rfind('\n\n', 0, MAX_FILE_CHARS)
+            content = content[:cut if cut > 0 else MAX_FILE_CHARS]
+        
+        # Chunk the content
+        chunks = chunk_text(content)
+        
+        return chunks, f" (file truncated to its first {len(content)} characters)" if truncated else ""
+    
+    except Exception as e:
+        return None, f"  Error processing {md_file}: {e}"
+
 def process_repository(repo_path: str, output_file: str = "chunks.json"):
     """
     Process all markdown files in a repository.
     
+    Files are chunked in parallel worker processes (chunking is pure-Python CPU work), and
+    records are written as they arrive rather than collected for one big dump: a JSON array
+    with one record per line, or plain JSONL when output_file ends in .jsonl.
+    
+    Each record is {"id", "text", "metadata"}. The id ("<file_path>:<chunk_index>") is fixed
+    here and carried through create_embeddings.py, so load_chromadb.py and convert_to_jsonl.py
+    use it as-is; batching for collection.add happens in load_chromadb.py, sized to the server.
+    With DEDUPE_CHUNKS, a chunk whose text was already written (by BLAKE2b digest) is skipped,
+    so only its first occurrence is stored; the remaining chunks keep their chunk_index (and
+    id), and total_chunks and the counts printed and returned cover only what was written.
+    
     Args:
         repo_path: Path to the repository root
-        output_file: JSON file to write chunks to
+        output_file: JSON (or .jsonl) file to write chunks to
+    
+    Returns:
+        Number of chunks written
     """
-    repo_path = Path(repo_path).expanduser()
-    chunks_data = []
+    root = str(Path(repo_path).expanduser())
+    output_path = Path(output_file)
+    jsonl = output_path.suffix == ".jsonl"
+    count = 0
+    duplicates = 0
+    seen = set()
+    if orjson is not None:
+        dumps = orjson.dumps
+    else:
+        dumps = lambda record: json.dumps(record, ensure_ascii=False).encode('utf-8')
     
-    # Find all markdown files
-    md_files = list(repo_path.rglob("*.md"))
+    # Find all markdown files (skipped directories aren't descended into)
+    md_files = list(iter_markdown_files(root))
     
     print(f"Found {len(md_files)} markdown files")
     
-    for md_file in md_files:
-        # Skip certain files
-        if any(skip in str(md_file) for skip in ['.git', 'node_modules', 'CHANGELOG']):
-            continue
-        
-        print(f"Processing: {md_file}")
-        
-        try:
-            content = read_markdown_file(str(md_file))
-            
-            # Skip very small files
-            if len(content) < 100:
-                print(f"  Skipping (too small): {md_file}")
-                continue
-            
-            # Chunk the content
-            chunks = chunk_text(content)
-            print(f"  Created {len(chunks)} chunks")
-            
-            # Create chunk records
-            for idx, chunk_content in enumerate(chunks):
-                chunk_data = {
-                    "text": chunk_content,
-                    "metadata": extract_metadata(str(md_file), idx, len(chunks))
-                }
-                chunks_data.append(chunk_data)
-        
-        except Exception as e:
-            print(f"  Error processing {md_file}: {e}")
-            continue
+    # Relative to the working directory, once per file rather than once per chunk
+    rel_paths = [os.path.relpath(md_file) for md_file in md_files]
     
-    # Save chunks to JSON file
-    output_path = Path(output_file)
-    with open(output_path, 'w', encoding='utf-8') as f:
-        json.dump(chunks_data, f, indent=2, ensure_ascii=False)
+    with ProcessPoolExecutor() as executor, open(output_path, 'wb') as f:
+        if not jsonl:
+            f.write(b"[")
+        for md_file, rel_path, (chunks, status) in zip(
+            md_files, rel_paths, executor.map(_process_one, md_files, chunksize=16)
+        ):
+            print(f"Processing: {md_file}")
+            if chunks is None:
+                print(status)
+                continue
+            kept = list(enumerate(chunks))
+            if DEDUPE_CHUNKS:
+                kept = []
+                for idx, chunk_content in enumerate(chunks):
+                    digest = hashlib.blake2b(chunk_content.encode('utf-8'), digest_size=16).digest()
+                    if digest not in seen:
+                        seen.add(digest)
+                        kept.append((idx, chunk_content))
+            skipped = len(chunks) - len(kept)
+            duplicates += skipped
+            print(f"  Created {len(kept)} chunks{status}" + (f", skipped {skipped} duplicates" if skipped else ""))
+            # One record and metadata dict per file, updated per chunk: each is serialized
+            # straight away, so nothing else holds on to them
+            metadata = extract_metadata(rel_path, 0, len(kept))
+            record = {"id": None, "text": None, "metadata": metadata}
+            for idx, chunk_content in kept:
+                # The id is what ChromaDB and Vector Search store the chunk under
+                record["id"] = f"{rel_path}:{idx}"
+                record["text"] = chunk_content
+                metadata["chunk_index"] = idx
+                if not jsonl:
+                    f.write(b",\n" if count else b"\n")
+                f.write(dumps(record))
+                if jsonl:
+                    f.write(b"\n")
+                count += 1
+        if not jsonl:
+            f.write(b"\n]\n")
     
-    print(f"\nProcessed {len(chunks_data)} total chunks")
+    print(f"\nProcessed {count} total chunks")
+    if duplicates:
+        print(f"Skipped {duplicates} duplicate chunks")
     print(f"Saved to: {output_path.absolute()}")
     
-    return chunks_data
+    return count
 
 if __name__ == "__main__":
     import sys
@@ -3,66 +3,130 @@
 Test querying the Vector Search index.
 """
 
+import asyncio
 import os
+from functools import lru_cache
 from google.cloud import aiplatform
 from vertexai.preview import vector_search
 from vertexai.language_models import TextEmbeddingModel
 
-def query_index(project_id: str, region: str, index_id: str, query_text: str, top_k: int = 5):
+# Questions per embedding request; several requests run concurrently (the API allows up to 250)
+EMBED_SHARD_SIZE = 50
+# At most this many embedding requests are in flight at once
+EMBED_CONCURRENCY = 8
+# Tried in order: text-embedding-004 is available in us-east1, the gecko models are fallbacks
+PREFERRED_MODELS = ("text-embedding-004", "textembedding-gecko@003", "textembedding-gecko@001")
+
+# (project, region) Vertex AI was last initialized for
+_initialized = None
+
+def _init(project_id: str, region: str):
+    global _initialized
+    if _initialized != (project_id, region):
+        aiplatform.init(project=project_id, location=region)
+        _initialized = (project_id, region)
+
+@lru_cache(maxsize=4)
+def _get_model(project_id: str, region: str):
+    """Load the first of PREFERRED_MODELS available in the region, once per (project, region)."""
+    _init(project_id, region)
+    error = None
+    for model_name in PREFERRED_MODELS:
+        try:
+            return TextEmbeddingModel.from_pretrained(model_name)
+        except Exception as e:
+            error = e
+    raise error
+
+@lru_cache(maxsize=4)
+def _get_index(project_id: str, region: str, index_id: str):
+    _init(project_id, region)
+    return vector_search.get_index(index_id=index_id)
+
+async def query_index_async(project_id: str, region: str, index_id: str, query_texts, top_k: int = 5):
     """
-    Query the vector index.
+    Embed the questions and fetch the index handle concurrently, then find their neighbors.
     
-    Args:
-        project_id: GCP project ID
-        region: GCP region
-        index_id: Vector Search index ID
-        query_text: User's question
-        top_k: Number of results to return
+    The SDK calls are blocking, so each runs in a worker thread; questions are embedded in
+    concurrent shards of EMBED_SHARD_SIZE (at most EMBED_CONCURRENCY at a time). Returns one list of neighbors per question.
     """
-    # Initialize
-    aiplatform.init(project=project_id, location=region)
+    if isinstance(query_texts, str):
+        query_texts = [query_texts]
+    _init(project_id, region)
     
-    # Create query embedding
-    # Try text-embedding-004 first (available in us-east1), fall back to gecko models
-    try:
-        model = TextEmbeddingModel.from_pretrained("text-embedding-004")
-    except Exception:
-        try:
-            model = TextEmbeddingModel.from_pretrained("textembedding-gecko@003")
-        except Exception:
-            model = TextEmbeddingModel.from_pretrained("textembedding-gecko@001")
-    query_embedding = model.get_embeddings([query_text])[0]
+    async def embed_shard(model, shard, slots):
+        async with slots:
+            return await asyncio.to_thread(model.get_embeddings, shard)
     
-    # Get index
-    index = vector_search.get_index(index_id=index_id)
+    async def embed_all():
+        model = await asyncio.to_thread(_get_model, project_id, region)
+        slots = asyncio.Semaphore(EMBED_CONCURRENCY)
+        shards = await asyncio.gather(*(
+            embed_shard(model, query_texts[start:start + EMBED_SHARD_SIZE], slots)
+            for start in range(0, len(query_texts), EMBED_SHARD_SIZE)
+        ))
+        return [embedding for shard in shards for embedding in shard]
+    
+    # The model and index handles are reused across calls
+    query_embeddings, index = await asyncio.gather(
+        embed_all(),
+        asyncio.to_thread(_get_index, project_id, region, index_id),
+    )
     
     # Query
-    results = index.find_neighbors(
+    return await asyncio.to_thread(
+        index.find_neighbors,
         deployed_index_id=None,  # Will be set when index is deployed
-        queries=[query_embedding.values],
+        queries=[embedding.values for embedding in query_embeddings],
         num_neighbors=top_k
     )
+
+def query_index(project_id: str, region: str, index_id: str, query_texts, top_k: int = 5):
+    """
+    Query the vector index with one or more questions.
+    
+    All questions go to the index in a single find_neighbors call (see query_index_async).
+    
+    Args:
+        project_id: GCP project ID
+        region: GCP region
+        index_id: Vector Search index ID
+        query_texts: User's question, or a list of questions
+        top_k: Number of results to return per question
+    """
+    if isinstance(query_texts, str):
+        query_texts = [query_texts]
+    
+    results = asyncio.run(query_index_async(project_id, region, index_id, query_texts, top_k))
     
-    print(f"Query: {query_text}")
-    print(f"\nFound {len(results[0])} results:\n")
+    for query_text, neighbors in zip(query_texts, results):
+        print(f"Query: {query_text}")
+        print(f"\nFound {len(neighbors)} results:\n")
+        
+        for i, result in enumerate(neighbors, 1):
+            print(f"{i}. Distance: {result.distance}")
+            print(f"   Metadata: {result.metadata}")
+            print()
     
-    for i, result in enumerate(results[0], 1):
-        print(f"{i}. Distance: {result.distance}")
-        print(f"   Metadata: {result.metadata}")
-        print()
+    return results
 
 if __name__ == "__main__":
     import sys
     
     if len(sys.argv) < 5:
-        print("Usage: python query_index.py <project_id> <region> <index_id> <query_text> [top_k]")
+        print("Usage: python query_index.py <project_id> <region> <index_id> <query_text | queries_file> [top_k]")
+        print("\n  queries_file  A file with one question per line, all sent as one batch")
         sys.exit(1)
     
     project_id = sys.argv[1]
     region = sys.argv[2]
     index_id = sys.argv[3]
-    query_text = sys.argv[4]
+    if os.path.isfile(sys.argv[4]):
+        with open(sys.argv[4], 'r', encoding='utf-8') as f:
+            query_texts = [line.strip() for line in f if line.strip()]
+    else:
+        query_texts = [sys.argv[4]]
     top_k = int(sys.argv[5]) if len(sys.argv) > 5 else 5
     
-    query_index(project_id, region, index_id, query_text, top_k)
+    query_index(project_id, region, index_id, query_texts, top_k)
 
@@ -22,25 +22,26 @@ def validate_chromadb(
         Path("../chroma_db"),
     ]
     
-    client = None
-    for persist_path in persist_paths:
-        if persist_path.exists():
-            try:
-                client = chromadb.PersistentClient(
-                    path=str(persist_path),
-                    settings=Settings(anonymized_telemetry=False)
-                )
-                print(f"✓ Connected to ChromaDB at: {persist_path.absolute()}")
-                break
-            except Exception as e:
-                continue
+    # Pick the database by its sqlite file and open a client only for that one; each
+    # PersistentClient start-up is expensive, and on an empty directory it creates a new database
+    resolved = next((p for p in persist_paths if (p / "chroma.sqlite3").exists()), None)
     
-    if client is None:
+    if resolved is None:
         print(f"✗ ChromaDB not found in any of these locations:")
         for path in persist_paths:
             print(f"  - {path.absolute()}")
         return False
     
+    try:
+        client = chromadb.PersistentClient(
+            path=str(resolved),
+            settings=Settings(anonymized_telemetry=False)
+        )
+    except Exception as e:
+        print(f"✗ Could not open ChromaDB at {resolved.absolute()}: {e}")
+        return False
+    print(f"✓ Connected to ChromaDB at: {resolved.absolute()}")
+    
     # Get collection
     try:
         collection = client.get_collection(name=collection_name)
@@ -48,10 +49,11 @@ def validate_chromadb(
         print(f"✓ Collection '{collection_name}' found")
         print(f"  Total documents: {count}")
         
-        # Get a few sample documents
+        # Get a few sample documents; peek includes their embeddings, so the first can be
+        # reused for the query test
         if count > 0:
             print("\nSample documents (first 3):")
-            results = collection.get(limit=3, include=["documents", "metadatas"])
+            results = collection.peek(limit=3)
             
             for i, (doc_id, doc_text, metadata) in enumerate(zip(
                 results["ids"],
@@ -66,13 +68,12 @@ def validate_chromadb(
         if count > 0:
             print("\n✓ Testing query capability...")
             try:
-                # Get a sample document to query against
-                sample = collection.get(limit=1, include=["embeddings"])
+                # Query against the first sample document's embedding
                 # Check if embeddings exist (check length, not the array itself)
-                has_embeddings = "embeddings" in sample and len(sample["embeddings"]) > 0
+                has_embeddings = results.get("embeddings") is not None and len(results["embeddings"]) > 0
                 if has_embeddings:
                     query_result = collection.query(
-                        query_embeddings=[sample["embeddings"][0]],
+                        query_embeddings=[results["embeddings"][0]],
                         n_results=min(3, count),
                         include=["documents", "metadatas", "distances"]
                     )